@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+
+"""
+Reproducible throughput benchmarks for the chunk hot path.
+
+Generates synthetic NanoAOD-like files locally (one per ROOT codec, plus awkward0
+tables for each codec from compression/experiments/make_awkward.py) and measures
+events/s and MB/s (of uncompressed arrays) for
+- raw readers (uproot3 vs uproot4) per ROOT codec
+- `DataFrameWrapper` vs `pdroot.ChunkDataFrame` (`CachedChunkDataFrame`) through the real
+  `get_results` on a `LocalCluster`, for a grid of chunk sizes
+- awkward0 table decompression per codec
+and prints one table so that regressions are visible between runs.
+
+    python benchmark.py --nevents 200000 --chunksizes 25e3,100e3 --output bench.json
+"""
+
+import os
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+MUON_BRANCHES = ["Muon_pt", "Muon_eta", "Muon_phi", "Muon_mass", "Muon_charge"]
+JET_BRANCHES = ["Jet_pt", "Jet_eta", "Jet_phi"]
+FLAT_BRANCHES = ["run", "luminosityBlock", "event", "MET_pt", "MET_phi"]
+READ_BRANCHES = ["MET_pt", "nMuon", "Muon_pt", "Muon_eta", "Muon_phi", "nJet", "Jet_pt"]
+
+ROOT_CODECS = ["none", "zlib", "lz4", "lzma"]
+
+def get_root_compression(codec):
+    import uproot3
+    return {
+            "none": None,
+            "zlib": uproot3.ZLIB(1),
+            "lz4": uproot3.LZ4(4),
+            "lzma": uproot3.LZMA(9),
+            }[codec]
+
+def make_synthetic_events(nevents, seed=42):
+    """
+    Return dict of branch name -> array (jagged ones as awkward0 JaggedArrays)
+    with roughly NanoAOD-like multiplicities and distributions
+    """
+    import awkward0
+    rng = np.random.default_rng(seed)
+    data = dict()
+    data["run"] = np.full(nevents, 316000, dtype=np.int32)
+    data["luminosityBlock"] = (np.arange(nevents) // 1000).astype(np.int32)
+    data["event"] = np.arange(nevents, dtype=np.int64)
+    data["MET_pt"] = rng.exponential(40., nevents).astype(np.float32)
+    data["MET_phi"] = rng.uniform(-np.pi, np.pi, nevents).astype(np.float32)
+    for prefix, mean, branches in [("Muon", 1.5, MUON_BRANCHES), ("Jet", 5., JET_BRANCHES)]:
+        counts = rng.poisson(mean, nevents).astype(np.int32)
+        ntotal = counts.sum()
+        data["n"+prefix] = counts
+        content = dict(
+                pt=rng.exponential(30., ntotal)+5.,
+                eta=rng.uniform(-2.5, 2.5, ntotal),
+                phi=rng.uniform(-np.pi, np.pi, ntotal),
+                mass=np.where(prefix == "Muon", 0.106, rng.exponential(10., ntotal)),
+                charge=rng.choice([-1, 1], ntotal),
+                )
+        for branch in branches:
+            values = content[branch.split("_", 1)[1]]
+            dtype = np.int32 if branch.endswith("charge") else np.float32
+            data[branch] = awkward0.JaggedArray.fromcounts(counts, values.astype(dtype))
+    return data
+
+def write_root_file(fname, data, codec="lz4", basket_entries=10000):
+    import uproot3
+    branches = dict()
+    counters = ["n" + prefix for prefix in ["Muon", "Jet"]]
+    for name, array in data.items():
+        if name in counters:
+            # created by uproot3 from the `size` of the jagged branches
+            continue
+        if name.startswith("Muon_") or name.startswith("Jet_"):
+            size = "n" + name.split("_", 1)[0]
+            branches[name] = uproot3.newbranch(np.dtype(array.content.dtype).newbyteorder(">"), size=size)
+        else:
+            branches[name] = np.dtype(array.dtype).newbyteorder(">")
+    nevents = len(data["event"])
+    with uproot3.recreate(fname, compression=get_root_compression(codec)) as f:
+        f["Events"] = uproot3.newtree(branches)
+        for start in range(0, nevents, basket_entries):
+            f["Events"].extend({name: array[start:start+basket_entries] for name, array in data.items()})
+
+def get_awkd_codecs():
+    """
+    Return list of (label, compress function, (module, decompress function name)),
+    mirroring compression/experiments/make_awkward.py, for codecs that are installed
+    """
+    codecs = [("lzma", lambda x: __import__("lzma").compress(x), ("lzma", "decompress"))]
+    try:
+        import blosc
+        codecs += [
+                ("blosc", lambda x: blosc.compress(x), ("blosc", "decompress")),
+                ("blosc_noshuffle", lambda x: blosc.compress(x, shuffle=blosc.NOSHUFFLE), ("blosc", "decompress")),
+                ("blosc_bitshuffle", lambda x: blosc.compress(x, shuffle=blosc.BITSHUFFLE), ("blosc", "decompress")),
+                ("blosc_zlib", lambda x: blosc.compress(x, cname="zlib"), ("blosc", "decompress")),
+                ("blosc_lz4", lambda x: blosc.compress(x, cname="lz4"), ("blosc", "decompress")),
+                ("blosc_lz4hc", lambda x: blosc.compress(x, cname="lz4hc"), ("blosc", "decompress")),
+                ]
+    except ImportError:
+        pass
+    try:
+        import lz4.frame
+        codecs += [
+                ("lz4_max", lambda x: lz4.frame.compress(x, compression_level=lz4.frame.COMPRESSIONLEVEL_MAX), ("lz4.frame", "decompress")),
+                ("lz4_min", lambda x: lz4.frame.compress(x, compression_level=lz4.frame.COMPRESSIONLEVEL_MIN), ("lz4.frame", "decompress")),
+                ("lz4_minhc", lambda x: lz4.frame.compress(x, compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC), ("lz4.frame", "decompress")),
+                ]
+    except ImportError:
+        pass
+    return codecs
+
+def arrays_nbytes(arrays):
+    return sum(getattr(array, "nbytes", 0) for array in arrays)
+
+def timed(func, *args, repeat=3, **kwargs):
+    """
+    Return (best wall time over `repeat` calls, last return value)
+    """
+    best, out = float("inf"), None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+def bench_readers(fnames_by_codec, nevents, branches=READ_BRANCHES, repeat=3):
+    import uproot3
+    import uproot4
+    def read_uproot3(fname):
+        return list(uproot3.open(fname)["Events"].arrays(branches, namedecode="ascii").values())
+    def read_uproot4(fname):
+        return list(uproot4.open(fname)["Events"].arrays(branches, how=dict).values())
+
+    rows = []
+    for codec, fname in fnames_by_codec.items():
+        for reader, func in [("uproot3", read_uproot3), ("uproot4", read_uproot4)]:
+            row = dict(benchmark="reader", reader=reader, codec=codec, chunksize=nevents)
+            try:
+                dt, arrays = timed(func, fname, repeat=repeat)
+                row.update(seconds=dt, events_per_s=nevents/dt, mb_per_s=1e-6*arrays_nbytes(arrays)/dt)
+            except Exception as e:
+                row.update(error=repr(e)[:120])
+            rows.append(row)
+    return rows
+
+def bench_awkd_codecs(data, outdir, branches=READ_BRANCHES, repeat=3):
+    import copy
+    import awkward0
+    table = awkward0.Table({name: data[name] for name in branches})
+    whitelist = awkward0.persist.whitelist + [["lz4.frame", "decompress"], ["blosc", "decompress"], ["lzma", "decompress"]]
+    nevents = len(table)
+    rows = []
+    for label, fcomp, fdecomp in get_awkd_codecs():
+        row = dict(benchmark="awkd", reader="awkward0", codec=label, chunksize=nevents)
+        try:
+            compression = copy.deepcopy(awkward0.persist.compression)
+            compression[0]["types"] += [np.float32]
+            compression[0]["pair"] = (fcomp, fdecomp)
+            fname = os.path.join(outdir, "table_{}.awkd".format(label))
+            t_compress, _ = timed(awkward0.save, fname, table, compression=compression, mode="w", repeat=1)
+            dt, _ = timed(awkward0.load, fname, whitelist=whitelist, repeat=repeat)
+            row.update(seconds=dt, events_per_s=nevents/dt, mb_per_s=1e-6*table.nbytes/dt,
+                    compress_seconds=t_compress, ratio=table.nbytes/os.stat(fname).st_size)
+        except Exception as e:
+            row.update(error=repr(e)[:120])
+        rows.append(row)
+    return rows
+
+def process_dataframe(df):
+    out = dict()
+    out["nbytes"] = 0
+    for branch in READ_BRANCHES:
+        array = df[branch]
+        out["nbytes"] += getattr(array, "nbytes", 0)
+    out["sum_met"] = float(np.sum(np.asarray(df["MET_pt"])))
+    return out
+
+def process_wrapper_chunk(chunk):
+    import utils
+    fname, entry_start, entry_stop = chunk
+    t0 = time.time()
+    out = process_dataframe(utils.DataFrameWrapper(fname, entry_start, entry_stop))
+    out["nevents_processed"] = entry_stop - entry_start
+    out["t_start"] = [t0]
+    out["t_stop"] = [time.time()]
+    return out
+
+def bench_get_results(fnames_by_codec, chunksizes, client, repeat=1):
+    import utils
+    rows = []
+    for codec, fname in fnames_by_codec.items():
+        for chunksize in chunksizes:
+            for reader, process, wrap_func in [
+                    ("DataFrameWrapper", process_wrapper_chunk, False),
+                    ("ChunkDataFrame", process_dataframe, True),
+                    ]:
+                row = dict(benchmark="get_results", reader=reader, codec=codec, chunksize=int(chunksize))
+                try:
+                    utils.clear_array_cache(client)
+                    dt, out = timed(utils.get_results, process, [fname], chunksize=chunksize, client=client,
+                            wrap_func=wrap_func, repeat=repeat)
+                    nevents = out["nevents_processed"]
+                    row.update(seconds=dt, events_per_s=nevents/dt, mb_per_s=1e-6*out["nbytes"]/dt)
+                except Exception as e:
+                    row.update(error=repr(e)[:120])
+                rows.append(row)
+    return rows
+
+def smoke_test(fname, client):
+    """
+    Run `get_results` over `fname` with default arguments (and with `warm_up=True`),
+    raising if either fails or miscounts events
+    """
+    import utils
+    nevents = utils.get_chunking((fname,), 1e9)[1]
+    for kwargs in [dict(warm_up=True, wrap_func=False), dict()]:
+        process = process_wrapper_chunk if kwargs.get("wrap_func") is False else process_dataframe
+        out = utils.get_results(process, [fname], client=client, **kwargs)
+        if out["nevents_processed"] != nevents:
+            raise RuntimeError("get_results({}) processed {} of {} events".format(kwargs, out["nevents_processed"], nevents))
+    print("Smoke test passed")
+
+def run_benchmarks(nevents=200000, codecs=ROOT_CODECS, chunksizes=(25e3, 100e3), nworkers=2, outdir=None,
+        skip_cluster=False, skip_awkd=False, repeat=3, smoke=True):
+    """
+    Generate the synthetic inputs in `outdir` (a temporary directory by default),
+    run all benchmarks (after `smoke_test`, if `smoke`) and return a pandas DataFrame with one row per measurement
+    """
+    import pandas as pd
+    outdir = outdir or tempfile.mkdtemp(prefix="daskucsd_bench_")
+    os.makedirs(outdir, exist_ok=True)
+
+    print("Generating {} synthetic events in {}".format(nevents, outdir))
+    data = make_synthetic_events(nevents)
+    fnames_by_codec = dict()
+    for codec in codecs:
+        fname = os.path.join(outdir, "nano_{}.root".format(codec))
+        if not os.path.exists(fname):
+            write_root_file(fname, data, codec=codec)
+        fnames_by_codec[codec] = fname
+
+    rows = bench_readers(fnames_by_codec, nevents, repeat=repeat)
+    if not skip_awkd:
+        rows += bench_awkd_codecs(data, outdir, repeat=repeat)
+    if not skip_cluster:
+        from dask.distributed import Client, LocalCluster
+        cluster = LocalCluster(n_workers=nworkers, threads_per_worker=1, dashboard_address=None,
+                preload=[os.path.join(os.path.dirname(os.path.abspath(__file__)), "cachepreload.py")])
+        client = Client(cluster)
+        try:
+            if smoke:
+                smoke_test(next(iter(fnames_by_codec.values())), client)
+            rows += bench_get_results(fnames_by_codec, chunksizes, client)
+        finally:
+            client.close()
+            cluster.close()
+
+    df = pd.DataFrame(rows)
+    for column in ["seconds", "events_per_s", "mb_per_s", "error"]:
+        if column not in df.columns:
+            df[column] = np.nan
+    return df
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--nevents", help="number of synthetic events per file", default=200000, type=int)
+    parser.add_argument("-c", "--codecs", help="comma separated ROOT codecs", default=",".join(ROOT_CODECS))
+    parser.add_argument("-s", "--chunksizes", help="comma separated chunk sizes for get_results", default="25e3,100e3")
+    parser.add_argument("-w", "--workers", help="number of LocalCluster workers", default=2, type=int)
+    parser.add_argument("-d", "--outdir", help="directory for synthetic inputs (reused if present)", default=None)
+    parser.add_argument("-r", "--repeat", help="repetitions per local measurement (best is kept)", default=3, type=int)
+    parser.add_argument("-o", "--output", help="write table to this json file", default=None)
+    parser.add_argument("--skip_cluster", help="skip get_results benchmarks", action="store_true")
+    parser.add_argument("--skip_awkd", help="skip awkward0 codec benchmarks", action="store_true")
+    parser.add_argument("--skip_smoke", help="skip the get_results smoke test", action="store_true")
+    args = parser.parse_args()
+
+    df = run_benchmarks(
+            nevents=args.nevents,
+            codecs=args.codecs.split(","),
+            chunksizes=[float(x) for x in args.chunksizes.split(",")],
+            nworkers=args.workers,
+            outdir=args.outdir,
+            skip_cluster=args.skip_cluster,
+            skip_awkd=args.skip_awkd,
+            repeat=args.repeat,
+            smoke=not args.skip_smoke,
+            )
+    print(df.to_string(index=False, float_format=lambda x: "{:.4g}".format(x)))
+    if args.output:
+        df.to_json(args.output)
@@ -5,9 +5,207 @@ def set_dask_config():
                      'distributed.worker.memory.pause': 0.95,
                      'distributed.worker.memory.terminate': 0.99})
 
+class ArrayCache(object):
+    """
+    Per-worker cache of branch arrays keyed by (filename, treename, branch, entry_start, entry_stop),
+    bounded by `max_bytes` and evicting by least-recently (policy="lru") or
+    least-frequently (policy="lfu") used key
+    """
+    def __init__(self, max_bytes, policy="lru"):
+        import collections
+        import threading
+        self.max_bytes = int(max_bytes)
+        self.policy = policy
+        self.data = collections.OrderedDict()
+        self.sizes = dict()
+        self.uses = collections.Counter()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sizeof(value):
+        nbytes = getattr(value, "nbytes", None)
+        if nbytes is None:
+            import sys
+            nbytes = sys.getsizeof(value)
+        return int(nbytes)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.uses[key] += 1
+            self.data.move_to_end(key)
+            return self.data[key]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        if hasattr(getattr(value, "flags", None), "writeable"):
+            # numpy arrays are shared by later chunks (and fused functions), so in-place edits must not reach them
+            value.flags.writeable = False
+        with self.lock:
+            if key in self.data:
+                self._remove(key)
+            while self.data and (self.current_bytes + size > self.max_bytes):
+                if self.policy == "lfu":
+                    victim = min(self.data, key=lambda k: self.uses[k])
+                else:
+                    victim = next(iter(self.data))
+                self._remove(victim)
+                self.evictions += 1
+            self.data[key] = value
+            self.sizes[key] = size
+            self.uses[key] += 1
+            self.current_bytes += size
+
+    def _remove(self, key):
+        del self.data[key]
+        self.current_bytes -= self.sizes.pop(key)
+        self.uses.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.uses.clear()
+            self.current_bytes = 0
+
+def get_memory_limit(worker):
+    limit = getattr(worker, "memory_limit", None)
+    if not limit and hasattr(worker, "memory_manager"):
+        limit = worker.memory_manager.memory_limit
+    return limit or 4e9
+
+def get_startup_timings():
+    """
+    Return dict of startup phase -> seconds, from the timings exported by the worker job
+    script (environment cache wait/fetch/extract) plus the time until this preload ran
+    """
+    import os
+    import time
+    timings = dict()
+    for item in os.getenv("DASKUCSD_STARTUP_TIMINGS", "").split(","):
+        if "=" in item:
+            k, v = item.split("=", 1)
+            try:
+                timings[k] = float(v)
+            except ValueError:
+                pass
+    if os.getenv("DASKUCSD_JOB_START"):
+        timings["worker_start"] = time.time() - float(os.getenv("DASKUCSD_JOB_START"))
+    return timings
+
+class LRUCache(object):
+    """
+    Small dict-like LRU cache holding up to `maxsize` items (open trees), so that
+    the preload doesn't need to import uproot4
+    """
+    def __init__(self, maxsize=100):
+        import collections
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        self.data.move_to_end(key)
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def clear(self):
+        self.data.clear()
+
+WARMUP_PROFILES = {
+        "none": [],
+        "uproot": ["numpy", "uproot4"],
+        "pdroot": ["numpy", "pandas", "uproot4", "pdroot", "yahist"],
+        "coffea": ["numpy", "uproot4", "coffea.processor", "coffea.executor"],
+        }
+
+def get_warmup_modules(spec=None):
+    """
+    Return the list of modules to import for a warm-up `spec` (default from
+    `DASKUCSD_WARMUP`, "pdroot"), a comma-separated list of profile names
+    from `WARMUP_PROFILES` and/or module names
+    """
+    import os
+    if spec is None:
+        spec = os.getenv("DASKUCSD_WARMUP", "pdroot")
+    modules = []
+    for item in spec.split(","):
+        item = item.strip()
+        for module in WARMUP_PROFILES.get(item, [item] if item else []):
+            if module not in modules:
+                modules.append(module)
+    return modules
+
+def import_modules(modules, timings=None):
+    """
+    Import `modules`, recording seconds per module in `timings` (-1 if not importable).
+    A module's time includes its dependencies that weren't imported yet.
+    """
+    import importlib
+    import time
+    timings = timings if timings is not None else dict()
+    for module in modules:
+        t0 = time.time()
+        try:
+            importlib.import_module(module)
+            timings[module] = time.time() - t0
+        except Exception:
+            timings[module] = -1.
+    return timings
+
 def dask_setup(worker):
+    """
+    Set up caches and metrics on the worker. Modules from the warm-up profile
+    (`DASKUCSD_WARMUP`) are imported in a background thread, so the worker registers
+    right away, and their import times are reported as import_* metrics. When loaded
+    as a nanny preload (`--preload-nanny`) with `DASKUCSD_PREFORK=1`, worker processes
+    are instead forked from a forkserver that has the profile imported already, so
+    restarted workers come up warm.
+    """
     import os
-    import uproot4
+    import threading
+    from distributed import Nanny
+
+    if isinstance(worker, Nanny):
+        if os.getenv("DASKUCSD_PREFORK", "0") == "1":
+            import dask
+            from distributed.utils import get_mp_context
+            # nanny preloads run before the worker process is started. get_mp_context sets
+            # its own forkserver preload list only on the first call, so override it afterwards
+            dask.config.set({"distributed.worker.multiprocessing-method": "forkserver"})
+            get_mp_context().set_forkserver_preload(["distributed"] + get_warmup_modules())
+        return
 
     set_dask_config()
 
@@ -24,7 +222,7 @@ def dask_setup(worker):
                 d[k.strip()] = v.strip().lstrip('"').strip('"')
         return d
     worker.classads = get_classads()
-    worker.tree_cache = uproot4.cache.LRUCache(100)
+    worker.tree_cache = LRUCache(100)
 
     def numtreescached_metric(worker):
         if hasattr(worker,"tree_cache"):
@@ -33,16 +231,22 @@ def dask_setup(worker):
 
     worker.metrics["numtreescached"] = numtreescached_metric
 
-    try:
-        # Load some imports initially
-        import pdroot
-        import yahist
-    except:
-        pass
-
-    try:
-        # Load some imports initially
-        import coffea.processor
-        import coffea.executor
-    except:
-        pass
+    worker.startup_timings = get_startup_timings()
+    for name in worker.startup_timings:
+        worker.metrics["startup_" + name] = lambda worker, name=name: worker.startup_timings[name]
+
+    cache_fraction = float(os.getenv("DASKUCSD_ARRAY_CACHE_FRACTION", 0.25))
+    cache_policy = os.getenv("DASKUCSD_ARRAY_CACHE_POLICY", "lru")
+    worker.array_cache = ArrayCache(cache_fraction*get_memory_limit(worker), policy=cache_policy)
+
+    worker.metrics["array_cache_hits"] = lambda worker: worker.array_cache.hits
+    worker.metrics["array_cache_misses"] = lambda worker: worker.array_cache.misses
+    worker.metrics["array_cache_evictions"] = lambda worker: worker.array_cache.evictions
+    worker.metrics["array_cache_bytes"] = lambda worker: worker.array_cache.current_bytes
+
+    modules = get_warmup_modules()
+    worker.import_timings = dict()
+    for module in modules:
+        worker.metrics["import_" + module] = lambda worker, module=module: worker.import_timings.get(module, 0.)
+    worker.metrics["import_total"] = lambda worker: sum(t for t in worker.import_timings.values() if t > 0)
+    threading.Thread(target=import_modules, args=(modules, worker.import_timings), daemon=True).start()
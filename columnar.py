@@ -0,0 +1,683 @@
+"""
+Local columnar cache of ROOT trees, read back with `np.memmap`.
+
+Each converted file is a directory under the cache root, named by a hash of the
+source filename, holding one `.npy` file per flat branch, and an `.offsets.npy`
+(nentries+1 int64 offsets) plus a `.npy` of the flattened content per jagged branch,
+together with a `meta.json` describing the branches. Any entry range of a branch is
+then a zero-copy slice of a memory-mapped array, and files are only paged in as read.
+
+Columns can instead be compressed in independent blocks (`.blk` data and a
+`.blocks.npy` table of element/byte offsets) with a codec picked per branch by
+`select_codec`, which benchmarks candidate codecs and shuffle modes on a sample of
+the branch (like compression/experiments/make_awkward.py) and applies a policy. The
+codec is recorded per branch in `meta.json` and readers decompress only the blocks
+overlapping the requested entries.
+
+`get_chunking` takes entry counts from the cache when a file has one, and
+`CachedChunkDataFrame` (`use_chunk_input`) reads branches from it when present,
+falling back to the ROOT file otherwise.
+
+    python columnar.py /hadoop/cms/store/.../*.root --root /hadoop/cms/store/user/$USER/columnar
+
+The default root (`DASKUCSD_COLUMNAR_PATH`, or ~/.daskucsd/columnar) is per user and
+per host. `get_results` passes the client's root to the workers, so for a cache to be
+used by condor workers it has to be on storage they see too (e.g., hadoop), set with
+`DASKUCSD_COLUMNAR_PATH` or `columnar_path`; otherwise workers just read ROOT.
+"""
+
+import os
+import json
+import time
+import shutil
+import threading
+import hashlib
+import argparse
+
+import numpy as np
+
+FORMAT_VERSION = 1
+DEFAULT_COLUMNAR_PATH = os.getenv("DASKUCSD_COLUMNAR_PATH", os.path.expanduser("~/.daskucsd/columnar"))
+
+_open_files = dict()
+
+def get_cache_path(fname, treename="Events", root=DEFAULT_COLUMNAR_PATH):
+    """
+    Return the cache directory for tree `treename` of `fname` under `root`
+    """
+    key = hashlib.sha1("{}:{}".format(os.path.abspath(fname) if "://" not in fname else fname, treename).encode()).hexdigest()[:20]
+    return os.path.join(root, key[:2], key)
+
+def stat(fname):
+    """
+    Return (mtime, size) for local files, and (-1, -1) for remote ones
+    (which are then trusted by name alone)
+    """
+    if "://" in fname:
+        return -1, -1
+    try:
+        st = os.stat(fname)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return -1, -1
+
+def read_meta(path):
+    try:
+        with open(os.path.join(path, "meta.json")) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+def find_cache(fname, treename="Events", root=DEFAULT_COLUMNAR_PATH):
+    """
+    Return the cache directory of `fname` if it exists and is up to date
+    with the source file (or `fname` itself if it is a columnar directory,
+    e.g., from `write_columns`), otherwise None
+    """
+    if os.path.isfile(os.path.join(fname, "meta.json")):
+        return fname
+    if not root:
+        return None
+    path = get_cache_path(fname, treename, root)
+    meta = read_meta(path)
+    if not meta or meta.get("version") != FORMAT_VERSION:
+        return None
+    mtime, size = stat(fname)
+    if (mtime, size) != (-1, -1) and [mtime, size] != [meta["source_mtime"], meta["source_size"]]:
+        return None
+    return path
+
+def open_columnar(fname, treename="Events", root=DEFAULT_COLUMNAR_PATH):
+    """
+    Return a `ColumnarFile` for `fname` if it has an up to date cache, otherwise None.
+    Open files are reused within the process until the directory is rewritten
+    (e.g., reconverted by another process), which is detected from its meta.json.
+    """
+    path = find_cache(fname, treename, root)
+    if path is None:
+        return None
+    try:
+        st = os.stat(os.path.join(path, "meta.json"))
+        version = (st.st_ino, st.st_mtime_ns)
+    except OSError:
+        return None
+    if path not in _open_files or _open_files[path][1] != version:
+        _open_files[path] = (ColumnarFile(path), version)
+    return _open_files[path][0]
+
+def get_file_metadata(fname, treename="Events", root=DEFAULT_COLUMNAR_PATH):
+    """
+    Return metadata like `utils.get_file_metadata` from the cache of `fname`,
+    or None if there's no cache
+    """
+    path = find_cache(fname, treename, root)
+    if path is None:
+        return None
+    meta = read_meta(path)
+    return dict(nentries=meta["nentries"], compressed_bytes=meta["nbytes"], boundaries=[0, meta["nentries"]])
+
+def make_jagged(offsets, content):
+    """
+    Return an awkward array (of the awkward version uproot4/pdroot use) from
+    `offsets` and flat `content` without copying `content`
+    """
+    try:
+        import awkward1 as ak
+    except ImportError:
+        import awkward as ak
+    if hasattr(ak, "contents"):
+        layout = ak.contents.ListOffsetArray(ak.index.Index64(offsets), ak.contents.NumpyArray(content))
+    else:
+        layout = ak.layout.ListOffsetArray64(ak.layout.Index64(offsets), ak.layout.NumpyArray(content))
+    return ak.Array(layout)
+
+def shuffle_bytes(data, itemsize):
+    """
+    Return `data` with the bytes of its `itemsize`-byte items grouped by significance
+    """
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, itemsize).T.tobytes()
+
+def unshuffle_bytes(data, itemsize):
+    return np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T.tobytes()
+
+def with_shuffle(compress, decompress):
+    return (lambda data, itemsize: compress(shuffle_bytes(data, itemsize)),
+            lambda data, itemsize: unshuffle_bytes(decompress(data), itemsize))
+
+_codecs = None
+
+# lzma is available by name, but too slow to benchmark (and to read) to be a default candidate
+DEFAULT_CANDIDATES = ["zlib", "zlib_shuffle", "lz4", "lz4_shuffle", "lz4hc_shuffle", "zstd", "zstd_shuffle",
+        "blosc_lz4_shuffle", "blosc_lz4_bitshuffle", "blosc_zstd_shuffle", "blosc_zstd_bitshuffle"]
+
+def get_codecs():
+    """
+    Return dict of codec name -> (compress(bytes, itemsize), decompress(bytes, itemsize))
+    for the codecs available in this environment
+    """
+    global _codecs
+    if _codecs is not None:
+        return _codecs
+    import lzma
+    import zlib
+    codecs = dict()
+    codecs["zlib"] = (lambda data, itemsize: zlib.compress(data, 1), lambda data, itemsize: zlib.decompress(data))
+    codecs["zlib_shuffle"] = with_shuffle(lambda data: zlib.compress(data, 1), zlib.decompress)
+    codecs["lzma"] = (lambda data, itemsize: lzma.compress(data), lambda data, itemsize: lzma.decompress(data))
+    try:
+        import lz4.frame
+        codecs["lz4"] = (lambda data, itemsize: lz4.frame.compress(data), lambda data, itemsize: lz4.frame.decompress(data))
+        codecs["lz4_shuffle"] = with_shuffle(lz4.frame.compress, lz4.frame.decompress)
+        codecs["lz4hc_shuffle"] = with_shuffle(lambda data: lz4.frame.compress(data, compression_level=lz4.frame.COMPRESSIONLEVEL_MINHC),
+                lz4.frame.decompress)
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        codecs["zstd"] = (lambda data, itemsize: zstandard.ZstdCompressor(level=3).compress(data),
+                lambda data, itemsize: zstandard.ZstdDecompressor().decompress(data))
+        codecs["zstd_shuffle"] = with_shuffle(zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress)
+    except ImportError:
+        pass
+    try:
+        import blosc
+        for cname in ["lz4", "zstd"]:
+            for label, shuffle in [("noshuffle", blosc.NOSHUFFLE), ("shuffle", blosc.SHUFFLE), ("bitshuffle", blosc.BITSHUFFLE)]:
+                codecs["blosc_{}_{}".format(cname, label)] = (
+                        lambda data, itemsize, cname=cname, shuffle=shuffle: blosc.compress(data, typesize=itemsize, cname=cname, shuffle=shuffle),
+                        lambda data, itemsize: blosc.decompress(data))
+    except ImportError:
+        pass
+    _codecs = codecs
+    return codecs
+
+def measure_codecs(data, candidates=None, repeat=1):
+    """
+    Return dict of codec -> (compressed bytes, decompression seconds) for numpy array
+    `data`, including "none" (0 seconds). `candidates` default to `DEFAULT_CANDIDATES`.
+    """
+    codecs = get_codecs()
+    raw = np.ascontiguousarray(data).tobytes()
+    itemsize = data.dtype.itemsize
+    results = {"none": (len(raw), 0.)}
+    for name in (candidates or DEFAULT_CANDIDATES):
+        if name not in codecs:
+            continue
+        compress, decompress = codecs[name]
+        compressed = compress(raw, itemsize)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            decompress(compressed, itemsize)
+            times.append(time.perf_counter() - t0)
+        results[name] = (len(compressed), min(times))
+    return results
+
+def choose_codec(measurements, nbytes, policy="throughput", bandwidth=200e6, budget=None):
+    """
+    Return the codec to use from `measure_codecs` output for `nbytes` uncompressed bytes:
+    - "throughput": the fastest to read, i.e., min(compressed bytes / `bandwidth` (bytes/s) + decompression time)
+    - "size": the smallest
+    - "budget": the smallest among those decompressing at least `budget` bytes/s
+    """
+    if policy == "size":
+        return min(measurements, key=lambda name: measurements[name][0])
+    if policy == "budget":
+        if budget is None:
+            raise ValueError("The budget policy needs a decompression `budget` in bytes/s")
+        fast = [name for name, (_, t) in measurements.items() if t == 0. or nbytes/t >= budget]
+        return min(fast or ["none"], key=lambda name: measurements[name][0])
+    if policy == "throughput":
+        return min(measurements, key=lambda name: measurements[name][0]/bandwidth + measurements[name][1])
+    raise ValueError("Unknown codec policy: {}".format(policy))
+
+def select_codec(data, policy="throughput", candidates=None, bandwidth=None, budget=None, sample_bytes=1<<20):
+    """
+    Return (codec, measurements) for numpy array `data`, benchmarking the candidate codecs
+    on (up to `sample_bytes` of) the middle of the array. `bandwidth` defaults to
+    `DASKUCSD_STORAGE_BANDWIDTH` (bytes/s, see `measure_bandwidth`).
+    """
+    if bandwidth is None:
+        bandwidth = float(os.getenv("DASKUCSD_STORAGE_BANDWIDTH", 200e6))
+    nsample = max(sample_bytes // max(data.dtype.itemsize, 1), 1)
+    start = max((len(data) - nsample)//2, 0)
+    sample = data[start:start+nsample]
+    if not len(sample):
+        return "none", dict()
+    measurements = measure_codecs(sample, candidates=candidates)
+    return choose_codec(measurements, sample.nbytes, policy=policy, bandwidth=bandwidth, budget=budget), measurements
+
+def plan_codecs(fname, treename="Events", branches=None, policy="throughput", candidates=None, bandwidth=None, budget=None):
+    """
+    Return dict of branch -> codec chosen with `select_codec` on the branches of `fname`,
+    to be passed as `codec` to `convert_file` for all files of a dataset (so codecs
+    are benchmarked once per dataset rather than for every file)
+    """
+    import uproot4
+    tree = uproot4.open(fname)[treename]
+    plan = dict()
+    for branch in (branches or tree.keys()):
+        split = split_array(tree[branch].array())
+        if split is None:
+            continue
+        data = split[1][1] if split[0] == "jagged" else split[1]
+        plan[branch] = select_codec(data, policy=policy, candidates=candidates, bandwidth=bandwidth, budget=budget)[0]
+    return plan
+
+def measure_bandwidth(fname, nbytes=256<<20, blocksize=4<<20):
+    """
+    Return read bandwidth (bytes/s) of the storage holding `fname` (e.g., an input file
+    or a file in the cache root), after asking the kernel to drop it from the page cache
+    """
+    with open(fname, "rb") as fh:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        t0 = time.time()
+        nread = 0
+        while nread < nbytes:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            nread += len(block)
+    return nread/max(time.time() - t0, 1e-6)
+
+def write_blocks(path, data, codec, block_size=1<<16):
+    """
+    Write numpy array `data` compressed with `codec` in blocks of `block_size` elements
+    to `path`.blk, with a table of (element offset, byte offset) rows in `path`.blocks.npy.
+    Returns the compressed size.
+    """
+    compress, _ = get_codecs()[codec]
+    data = np.ascontiguousarray(data)
+    table = [(0, 0)]
+    with open(path + ".blk", "wb") as fh:
+        for start in range(0, len(data), block_size):
+            compressed = compress(data[start:start+block_size].tobytes(), data.dtype.itemsize)
+            fh.write(compressed)
+            table.append((min(start+block_size, len(data)), table[-1][1] + len(compressed)))
+    np.save(path + ".blocks.npy", np.array(table, dtype=np.int64))
+    return table[-1][1]
+
+class ColumnarFile(object):
+    """
+    Read access to a converted file. `array(branch, entry_start, entry_stop)` returns
+    a memory-mapped numpy slice for flat branches and an awkward array over
+    memory-mapped content for jagged ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.num_entries = self.meta["nentries"]
+        self._arrays = dict()
+
+    def keys(self):
+        return list(self.meta["branches"].keys())
+
+    def __contains__(self, branch):
+        return branch in self.meta["branches"]
+
+    def _load(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    def _data(self, branch, start, stop):
+        """
+        Return elements [start, stop) of the (flat or content) data of `branch`,
+        decompressing only the overlapping blocks of compressed columns
+        """
+        info = self.meta["branches"][branch]
+        if info["codec"] == "none":
+            return self._load(branch)[start:stop]
+        dtype = np.dtype(info["dtype"])
+        if stop <= start:
+            return np.zeros(0, dtype=dtype)
+        _, decompress = get_codecs()[info["codec"]]
+        table = self._load(branch + ".blocks")
+        if branch + ".blk" not in self._arrays:
+            self._arrays[branch + ".blk"] = np.memmap(os.path.join(self.path, branch + ".blk"), dtype=np.uint8, mode="r")
+        blk = self._arrays[branch + ".blk"]
+        first = np.searchsorted(table[:, 0], start, side="right") - 1
+        last = np.searchsorted(table[:, 0], stop, side="left")
+        parts = [np.frombuffer(decompress(blk[table[i, 1]:table[i+1, 1]].tobytes(), dtype.itemsize), dtype=dtype)
+                for i in range(first, last)]
+        offset = table[first, 0]
+        return np.concatenate(parts)[start-offset:stop-offset]
+
+    def array(self, branch, entry_start=None, entry_stop=None):
+        info = self.meta["branches"][branch]
+        entry_start = 0 if entry_start is None else entry_start
+        entry_stop = self.num_entries if entry_stop is None else min(entry_stop, self.num_entries)
+        if info["kind"] == "flat":
+            return self._data(branch, entry_start, entry_stop)
+        offsets = self._load(branch + ".offsets")[entry_start:entry_stop+1]
+        content = self._data(branch, offsets[0], offsets[-1])
+        return make_jagged(np.asarray(offsets - offsets[0]), content)
+
+    def arrays(self, branches, entry_start=None, entry_stop=None):
+        return {branch: self.array(branch, entry_start, entry_stop) for branch in branches}
+
+def split_array(array):
+    """
+    Return ("flat", data) or ("jagged", (offsets, content)) numpy arrays for an
+    awkward array read by uproot4, or None if it's neither
+    """
+    layout = array.layout
+    if hasattr(layout, "starts") and not hasattr(layout, "offsets"):
+        # e.g., after masking: repack into contiguous offsets/content
+        try:
+            import awkward1 as ak
+        except ImportError:
+            import awkward as ak
+        layout = (ak.to_packed(array) if hasattr(ak, "to_packed") else ak.packed(array)).layout
+    if hasattr(layout, "offsets") and hasattr(layout, "content"):
+        offsets = np.asarray(layout.offsets).astype(np.int64)
+        content = np.asarray(getattr(layout.content, "data", layout.content))
+        if content.dtype.kind not in "biuf":
+            return None
+        return "jagged", (offsets - offsets[0], content[offsets[0]:offsets[-1]])
+    data = np.asarray(array)
+    if data.dtype.kind not in "biuf":
+        return None
+    return "flat", data
+
+def write_column(path, branch, split, codec="none", policy="throughput", candidates=None, bandwidth=None, budget=None,
+        block_size=1<<16):
+    """
+    Write one branch (`split` as returned by `split_array`) into directory `path`,
+    and return (branch info for meta.json, bytes written)
+    """
+    kind, data = split
+    nbytes = 0
+    if kind == "jagged":
+        offsets, data = data
+        np.save(os.path.join(path, branch + ".offsets.npy"), offsets)
+        nbytes += offsets.nbytes
+    info = dict(kind=kind, dtype=data.dtype.str, codec=codec)
+    if codec == "auto":
+        info["codec"], measurements = select_codec(data, policy=policy, candidates=candidates, bandwidth=bandwidth, budget=budget)
+        info["measurements"] = {name: [n, round(t, 6)] for name, (n, t) in measurements.items()}
+    if info["codec"] == "none":
+        np.save(os.path.join(path, branch + ".npy"), np.ascontiguousarray(data))
+        nbytes += data.nbytes
+    else:
+        nbytes += write_blocks(os.path.join(path, branch), data, info["codec"], block_size=block_size)
+    return info, nbytes
+
+def write_columns(path, arrays, nentries, codec="none", overwrite=True, **meta):
+    """
+    Write dict of branch -> awkward/numpy array (all with `nentries` entries) as a
+    standalone columnar directory at `path`, which can be passed to `get_results`
+    like a ROOT file. Extra `meta` is stored in meta.json. With `overwrite=False`, an
+    existing complete directory (e.g., from a concurrent copy of the same task) is kept.
+    """
+    if not overwrite and read_meta(path):
+        return path
+    tmppath = "{}.tmp{}.{}".format(path, os.getpid(), threading.get_ident())
+    shutil.rmtree(tmppath, ignore_errors=True)
+    os.makedirs(tmppath)
+    meta = dict(meta, version=FORMAT_VERSION, nentries=int(nentries), nbytes=0, branches=dict(), skipped=[],
+            source_mtime=-1, source_size=-1)
+    try:
+        for branch, array in arrays.items():
+            split = ("flat", array) if isinstance(array, np.ndarray) else split_array(array)
+            if split is None:
+                meta["skipped"].append(branch)
+                continue
+            meta["branches"][branch], nbytes = write_column(tmppath, branch, split, codec=codec)
+            meta["nbytes"] += nbytes
+        with open(os.path.join(tmppath, "meta.json"), "w") as fh:
+            json.dump(meta, fh)
+    except BaseException:
+        shutil.rmtree(tmppath, ignore_errors=True)
+        raise
+    if overwrite:
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        # another writer published `path` first
+        shutil.rmtree(tmppath, ignore_errors=True)
+        if not read_meta(path):
+            raise
+    _open_files.pop(path, None)
+    return path
+
+def convert_file(fname, treename="Events", root=DEFAULT_COLUMNAR_PATH, branches=None, overwrite=False,
+        codec="none", policy="throughput", candidates=None, bandwidth=None, budget=None, block_size=1<<16, threads=1):
+    """
+    Convert `branches` (default all numeric flat and jagged branches) of tree `treename` of
+    `fname` into its cache directory under `root`, and return the directory. The cache
+    is written to a temporary directory and moved in place at the end, so readers
+    never see a partial conversion. With `threads` > 1, branches are converted concurrently.
+
+    `codec` is "none" (memory-mapped), a name from `get_codecs()`, "auto" to pick
+    one per branch with `select_codec(policy, candidates, bandwidth, budget)`, or a dict
+    of branch -> codec (e.g., from `plan_codecs`; other branches use "auto").
+    """
+    import uproot4
+    path = get_cache_path(fname, treename, root)
+    if not overwrite and find_cache(fname, treename, root):
+        return path
+    tmppath = "{}.tmp{}".format(path, os.getpid())
+    shutil.rmtree(tmppath, ignore_errors=True)
+    os.makedirs(tmppath)
+    try:
+        t0 = time.time()
+        mtime, size = stat(fname)
+        tree = uproot4.open(fname)[treename]
+        meta = dict(version=FORMAT_VERSION, source=fname, treename=treename, source_mtime=mtime, source_size=size,
+                nentries=int(tree.num_entries), nbytes=0, branches=dict(), skipped=[])
+
+        def convert_branch(branch):
+            split = split_array(tree[branch].array())
+            if split is None:
+                return branch, None, 0
+            branch_codec = codec.get(branch, "auto") if isinstance(codec, dict) else codec
+            return (branch,) + write_column(tmppath, branch, split, codec=branch_codec, policy=policy, candidates=candidates,
+                    bandwidth=bandwidth, budget=budget, block_size=block_size)
+
+        branches = branches or tree.keys()
+        if threads > 1:
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+                converted = list(executor.map(convert_branch, branches))
+        else:
+            converted = list(map(convert_branch, branches))
+        for branch, info, nbytes in converted:
+            if info is None:
+                meta["skipped"].append(branch)
+                continue
+            meta["branches"][branch] = info
+            meta["nbytes"] += nbytes
+        meta["convert_time"] = time.time() - t0
+        with open(os.path.join(tmppath, "meta.json"), "w") as fh:
+            json.dump(meta, fh)
+    except BaseException:
+        shutil.rmtree(tmppath, ignore_errors=True)
+        raise
+    if overwrite:
+        shutil.rmtree(path, ignore_errors=True)
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        # another writer published `path` first
+        shutil.rmtree(tmppath, ignore_errors=True)
+        if not read_meta(path):
+            raise
+    _open_files.pop(path, None)
+    return path
+
+def checksum_path(path):
+    """
+    Return an adler32 checksum over the names and contents of the files in directory `path`
+    """
+    import zlib
+    checksum = 1
+    for name in sorted(os.listdir(path)):
+        checksum = zlib.adler32(name.encode(), checksum)
+        with open(os.path.join(path, name), "rb") as fh:
+            for block in iter(lambda: fh.read(1 << 22), b""):
+                checksum = zlib.adler32(block, checksum)
+    return "{:08x}".format(checksum & 0xffffffff)
+
+class Manifest(object):
+    """
+    Persistent sqlite record of a dataset conversion: one row per input file with
+    its output, output checksum and size, or the error if it failed
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS outputs (
+                input TEXT PRIMARY KEY, output TEXT, checksum TEXT, nbytes INTEGER,
+                status TEXT, error TEXT, seconds REAL, finished REAL
+            )""")
+        self.conn.commit()
+
+    def record(self, row):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO outputs VALUES (?,?,?,?,?,?,?,?)",
+                    (row["input"], row.get("output"), row.get("checksum"), row.get("nbytes"),
+                        "done" if row.get("error") is None else "failed", row.get("error"), row.get("seconds"), time.time()))
+
+    def done(self):
+        """
+        Return dict of input -> (output, checksum) for successfully converted inputs
+        """
+        rows = self.conn.execute("SELECT input, output, checksum FROM outputs WHERE status = 'done'").fetchall()
+        return {inp: (out, checksum) for inp, out, checksum in rows}
+
+    def failed(self):
+        return dict(self.conn.execute("SELECT input, error FROM outputs WHERE status = 'failed'").fetchall())
+
+def convert_task(fname, root=DEFAULT_COLUMNAR_PATH, **kwargs):
+    """
+    Convert `fname` with `convert_file` and return a manifest row (with the error
+    message instead of raising)
+    """
+    t0 = time.time()
+    try:
+        path = convert_file(fname, root=root, **kwargs)
+        nbytes = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+        return dict(input=fname, output=path, checksum=checksum_path(path), nbytes=nbytes, seconds=time.time()-t0)
+    except Exception as e:
+        return dict(input=fname, error="{}: {}".format(type(e).__name__, e), seconds=time.time()-t0)
+
+def get_dataset_codecs(fname, manifest_path, client=None, **kwargs):
+    """
+    Return the per-branch codecs for a dataset conversion, stored next to the manifest
+    (so resumed conversions use the same ones) or planned on `fname` with `plan_codecs`.
+    Stored codecs are planned again if the planning arguments changed since.
+    """
+    path = os.path.splitext(manifest_path)[0] + ".codecs.json"
+    plan_kwargs = {k: kwargs[k] for k in ["treename", "branches", "policy", "candidates", "bandwidth", "budget"] if k in kwargs}
+    # normalized like the stored copy (tuples become lists)
+    params = json.loads(json.dumps(plan_kwargs))
+    if os.path.exists(path):
+        with open(path) as fh:
+            stored = json.load(fh)
+        if stored.get("params") == params:
+            return stored["codecs"]
+        print("Codec planning arguments changed since {}, choosing codecs again".format(path))
+    print("Choosing codecs per branch on {}".format(fname))
+    if client is not None:
+        plan = client.submit(plan_codecs, fname, pure=False, **plan_kwargs).result()
+    else:
+        plan = plan_codecs(fname, **plan_kwargs)
+    with open(path, "w") as fh:
+        json.dump(dict(params=params, codecs=plan), fh)
+    counts = dict()
+    for codec in plan.values():
+        counts[codec] = counts.get(codec, 0) + 1
+    print("Codecs: {}".format(", ".join("{} ({})".format(k, v) for k, v in sorted(counts.items(), key=lambda x: -x[1]))))
+    return plan
+
+def convert_dataset(fnames, root=DEFAULT_COLUMNAR_PATH, manifest_path=None, client=None, workers=4, threads=4,
+        verify=False, retry_failed=True, **kwargs):
+    """
+    Convert `fnames` to the columnar cache under `root`, on a dask `client` if given, or a
+    local pool of `workers` processes, with `threads` branches converted concurrently per file.
+    Every finished file is recorded in the manifest (default `root`/manifest.sqlite), and
+    inputs already in it are skipped, so an interrupted conversion picks up where it stopped
+    without scanning the output area. With `verify=True`, recorded outputs are checksummed
+    again and redone if they changed or disappeared. Remaining keyword arguments go to `convert_file`;
+    with `codec="auto"`, codecs are chosen once on the first file (see `get_dataset_codecs`).
+    Returns the manifest.
+    """
+    from tqdm.auto import tqdm
+    manifest = Manifest(manifest_path or os.path.join(root, "manifest.sqlite"))
+    done = manifest.done()
+    if verify:
+        for fname, (output, checksum) in list(done.items()):
+            if not os.path.isdir(output) or checksum_path(output) != checksum:
+                print("Output of {} is missing or changed, redoing it".format(fname))
+                del done[fname]
+    failed = manifest.failed()
+    todo = [fname for fname in dict.fromkeys(fnames) if fname not in done and (retry_failed or fname not in failed)]
+    print("Converting {} files ({} already done)".format(len(todo), len(set(fnames)) - len(todo)))
+    if not todo:
+        return manifest
+    kwargs = dict(kwargs, root=root, threads=threads, overwrite=True)
+    if kwargs.get("codec") == "auto":
+        kwargs["codec"] = get_dataset_codecs(todo[0], manifest.path, client=client, **kwargs)
+    bar = tqdm(total=len(todo), unit="files")
+    nfailed = 0
+    if client is not None:
+        from dask.distributed import as_completed
+        futures = client.map(convert_task, todo, pure=False, **kwargs)
+        completed = (future.result() for future in as_completed(futures))
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(workers)
+        futures = [executor.submit(convert_task, fname, **kwargs) for fname in todo]
+        completed = (future.result() for future in concurrent.futures.as_completed(futures))
+    try:
+        for row in completed:
+            manifest.record(row)
+            if row.get("error"):
+                nfailed += 1
+                print("Failed to convert {}: {}".format(row["input"], row["error"]))
+            bar.update(1)
+    finally:
+        bar.close()
+        if client is not None:
+            client.cancel(futures)
+        else:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+    print("Converted {} files, {} failed".format(len(todo) - nfailed, nfailed))
+    return manifest
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("fnames", help="input ROOT files (or glob patterns)", nargs="+")
+    parser.add_argument("-r", "--root", help="cache root directory", default=DEFAULT_COLUMNAR_PATH)
+    parser.add_argument("-t", "--treename", help="tree name", default="Events")
+    parser.add_argument("-b", "--branches", help="comma-separated branches (default all)", default="")
+    parser.add_argument("-c", "--codec", help="codec, or auto to select per branch", default="none")
+    parser.add_argument("-p", "--policy", help="codec selection policy (throughput, size, budget)", default="throughput")
+    parser.add_argument("--bandwidth", help="storage bandwidth in bytes/s for the throughput policy", default=None, type=float)
+    parser.add_argument("--budget", help="minimum decompression bytes/s for the budget policy", default=None, type=float)
+    parser.add_argument("-m", "--manifest", help="manifest path (default ROOT/manifest.sqlite)", default=None)
+    parser.add_argument("-s", "--scheduler", help="dask scheduler address (default: local process pool)", default="")
+    parser.add_argument("-n", "--workers", help="local worker processes", default=4, type=int)
+    parser.add_argument("-j", "--threads", help="branches converted concurrently per file", default=4, type=int)
+    parser.add_argument("--verify", help="re-checksum outputs in the manifest", action="store_true")
+    args = parser.parse_args()
+
+    import glob
+    fnames = [fname for pattern in args.fnames for fname in (sorted(glob.glob(pattern)) if "*" in pattern else [pattern])]
+    client = None
+    if args.scheduler:
+        from dask.distributed import Client
+        client = Client(args.scheduler)
+    convert_dataset(fnames, root=args.root, manifest_path=args.manifest, client=client, workers=args.workers,
+            threads=args.threads, verify=args.verify, treename=args.treename,
+            branches=args.branches.split(",") if args.branches else None,
+            codec=args.codec, policy=args.policy, bandwidth=args.bandwidth, budget=args.budget)
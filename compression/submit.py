@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+"""
+Convert the DoubleMuon NanoAOD files to the columnar cache (--codec, default: auto)
+with the resumable driver in columnar.py, either on a running dask cluster (-s) or a
+local process pool. Replaces the condor_awkd and condor_lz4 submit scripts
+(the latter is `--codec lz4`, which writes lz4 columnar caches rather than ROOT files). Progress is kept in a manifest next to the outputs, so rerunning only
+converts what's missing.
+"""
+
+import os
+import sys
+import glob
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+import columnar
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--pattern", help="input file glob", default="/hadoop/cms/store/group/snt/nanoaod/DoubleMuon__*Nano1June2019*/*.root")
+    parser.add_argument("-c", "--codec", help="codec, or auto to choose one per branch", default="auto")
+    parser.add_argument("-o", "--outdir", help="output root directory (default: .../nanoaod/columnar/, or columnar_<codec>/ for a fixed codec)", default="")
+    parser.add_argument("-s", "--scheduler", help="dask scheduler address (default: local process pool)", default="")
+    parser.add_argument("-n", "--workers", help="local worker processes", default=4, type=int)
+    parser.add_argument("-d", "--dry_run", help="only print how many files would be converted", action="store_true")
+    parser.add_argument("--verify", help="re-checksum outputs in the manifest", action="store_true")
+    args = parser.parse_args()
+    if not args.outdir:
+        args.outdir = "/hadoop/cms/store/group/snt/nanoaod/{}/".format("columnar" if args.codec == "auto" else "columnar_" + args.codec)
+
+    fnames = sorted(glob.glob(args.pattern))
+    if args.dry_run:
+        done = columnar.Manifest(os.path.join(args.outdir, "manifest.sqlite")).done()
+        print("Would convert {} of {} files".format(len([f for f in fnames if f not in done]), len(fnames)))
+        sys.exit()
+
+    client = None
+    if args.scheduler:
+        from dask.distributed import Client
+        client = Client(args.scheduler)
+    columnar.convert_dataset(fnames, root=args.outdir, client=client, workers=args.workers, verify=args.verify, codec=args.codec)
@@ -19,24 +19,126 @@ if ! ls /hadoop/cms/store/ ; then
     exit 1
 fi
 
+function now {
+    date +%s.%N
+}
+
+function elapsed {
+    awk "BEGIN {printf \"%.2f\", $(now) - $1}"
+}
+
+# extract tarball $1 (.tar.zst/.tar.lz4/.tar.gz/.tar) into directory $2
+function extract {
+    case "$1" in
+        *.zst) zstd -dc -T0 "$1" | tar xf - -C "$2" ;;
+        *.lz4) lz4 -dc "$1" | tar xf - -C "$2" ;;
+        *.gz) if command -v pigz >/dev/null ; then tar -I pigz -xf "$1" -C "$2" ; else tar xzf "$1" -C "$2" ; fi ;;
+        *) tar xf "$1" -C "$2" ;;
+    esac
+}
+
+t_job=$(now)
 mkdir temp ; cd temp
 
 tarballpath=$(getjobad tarballpath)
+envhash=$(getjobad envhash)
+envcachedir=$(getjobad envcachedir)
+envcachedir=${envcachedir:-/tmp/daskenvs_$(whoami)}
+tarballname=$(basename $tarballpath)
 
-# mv ../{daskworkerenv.tar.*,*.py} .
-# xrdcp root://redirector.t2.ucsd.edu//store/user/namin/dask/daskworkerenv.tar.gz .
-xrdcp $tarballpath .
 mv ../*.py .
-echo "started extracting at $(date +%s)"
-tar xf daskworkerenv.tar.*
-echo "finished extracting at $(date +%s)"
 
+# fetch and extract the environment tarball into $envdir, recording timings in ./envtimings
+function fetch_env {
+    echo "Fetching $tarballpath"
+    t0=$(now)
+    xrdcp -f $tarballpath $envdir.$tarballname || return 1
+    echo "fetch $(elapsed $t0)" > envtimings
+    t0=$(now)
+    rm -rf $envdir && mkdir -p $envdir
+    extract $envdir.$tarballname $envdir || return 1
+    rm -f $envdir.$tarballname
+    if [ -x $envdir/daskworkerenv/bin/conda-unpack ]; then
+        $envdir/daskworkerenv/bin/conda-unpack
+    fi
+    echo "extract $(elapsed $t0)" >> envtimings
+    touch $envdir/.complete
+}
+
+# true if fd $1 still refers to file $2 (i.e., a cleanup didn't remove the lock file meanwhile)
+function same_file {
+    [ "$(stat -L -c %d:%i /dev/fd/$1 2>/dev/null)" == "$(stat -c %d:%i $2 2>/dev/null)" ]
+}
+
+# Make sure the cached environment is complete, holding a shared lock on $envdir.lock
+# (fd 9) for the job's lifetime (inherited by the worker), which the cleanup below
+# respects. The first job on a node fetches it under an exclusive lock on a separate
+# $envdir.fetchlock, held only while fetching, so concurrent jobs wait for the fetch
+# (instead of all hitting the redirector) but not for each other's workers.
+function setup_cached_env {
+    while true; do
+        exec 9>>$envdir.lock
+        flock -s -w 900 9 || return 1
+        # a cleanup may have removed the lock file (and env) while we waited
+        same_file 9 $envdir.lock || continue
+        if [ ! -f $envdir/.complete ]; then
+            (
+                flock -x -w 900 8 || exit 1
+                [ -f $envdir/.complete ] || fetch_env
+            ) 8>>$envdir.fetchlock || return 1
+        fi
+        # mark as used for the cleanup
+        touch $envdir
+        return 0
+    done
+}
 
-source daskworkerenv/bin/activate
+# Remove environments (and their lock files and leftover tarballs) on this node that
+# haven't been used in a week, skipping any that a job holds a lock on
+function cleanup_env_cache {
+    local name base
+    for name in $(find $envcachedir -mindepth 1 -maxdepth 1 -mtime +7 -printf "%f\n" 2>/dev/null | cut -d. -f1 | sort -u); do
+        base=$envcachedir/$name
+        [ "$base" == "$envdir" ] && continue
+        (
+            flock -n -x 7 || exit 0
+            same_file 7 $base.lock || exit 0
+            [ -n "$(find $base -maxdepth 0 -mtime -8 2>/dev/null)" ] && exit 0
+            rm -rf $base $base.*
+        ) 7>>$base.lock
+    done
+}
+
+# The unpacked environment is cached on the node under its content hash.
+# Without a hash, fall back to a private copy.
+t_fetch=0 ; t_extract=0 ; cache_hit=1
+if [ -n "$envhash" ] && mkdir -p $envcachedir ; then
+    envdir=$envcachedir/$envhash
+    t_wait=$(now)
+    setup_cached_env || { echo "ERROR! Couldn't set up the worker environment" ; exit 1 ; }
+    t_wait=$(elapsed $t_wait)
+    cleanup_env_cache
+else
+    [ -n "$envhash" ] && echo "Can't make env cache dir $envcachedir, not caching"
+    envdir=$(pwd)/env
+    t_wait=0
+    fetch_env || { echo "ERROR! Couldn't set up the worker environment" ; exit 1 ; }
+fi
+if [ -f envtimings ]; then
+    cache_hit=0
+    t_fetch=$(awk '/fetch/ {print $2}' envtimings)
+    t_extract=$(awk '/extract/ {print $2}' envtimings)
+fi
+
+source $envdir/daskworkerenv/bin/activate
 
 ls -lrth
 export PYTHONPATH=`pwd`:$PYTHONPATH
-export PATH=`pwd`/daskworkerenv/bin:$PATH
+export PATH=$envdir/daskworkerenv/bin:$PATH
+
+export DASKUCSD_STARTUP_TIMINGS="cache_hit=$cache_hit,env_wait=$t_wait,env_fetch=$t_fetch,env_extract=$t_extract,env_total=$(elapsed $t_job)"
+export DASKUCSD_JOB_START=$t_job
+echo "Startup timings: $DASKUCSD_STARTUP_TIMINGS"
 
 export DASK_DISTRIBUTED__WORKER__MEMORY__TARGET=0.85
 export DASK_DISTRIBUTED__WORKER__MEMORY__SPILL=0.90
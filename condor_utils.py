@@ -97,6 +97,55 @@ class UCSDHTCondorCluster(HTCondorCluster):
     job_cls = UCSDHTCondorJob
     config_name = "htcondor"
 
+def get_env_hash(path):
+    """
+    Return a short sha256 content hash of the worker environment tarball at `path`, which
+    keys the node-local cache of the unpacked environment in the worker job script.
+    The hash is remembered in `path`.sha256 until the tarball changes.
+    """
+    import hashlib
+    import json
+    st = os.stat(path)
+    cache = path + ".sha256"
+    try:
+        with open(cache) as fh:
+            info = json.load(fh)
+        if (info["mtime"], info["size"]) == (st.st_mtime, st.st_size):
+            return info["hash"]
+    except (IOError, ValueError, KeyError):
+        pass
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 22), b""):
+            h.update(block)
+    envhash = h.hexdigest()[:16]
+    try:
+        with open(cache, "w") as fh:
+            json.dump(dict(mtime=st.st_mtime, size=st.st_size, hash=envhash), fh)
+    except IOError:
+        pass
+    return envhash
+
+def pack_worker_env(envname="daskworkerenv", output=None, codec="zstd", level=3, threads=8):
+    """
+    conda-pack the environment `envname` into an uncompressed tar and compress it with
+    `codec` ("zstd", "lz4" or "gz"). zstd/lz4 decompress several times faster than
+    `--compress-level 9` gzip on the worker nodes, for a somewhat larger file.
+    Returns the output path.
+    """
+    ext = dict(zstd="zst", lz4="lz4", gz="gz")[codec]
+    output = output or "{}.tar.{}".format(envname, ext)
+    tarname = output.rsplit(".", 1)[0]
+    excludes = " ".join('--exclude "{}"'.format(x) for x in ["*.pyc", "*.js.map", "*.a", "*pandoc"])
+    os.system("conda pack -n {} --arcroot daskworkerenv -f --format tar -o {} {}".format(envname, tarname, excludes))
+    if codec == "zstd":
+        os.system("zstd -f -T{} -{} --rm {} -o {}".format(threads, level, tarname, output))
+    elif codec == "lz4":
+        os.system("lz4 -f -{} --rm {} {}".format(level, tarname, output))
+    else:
+        os.system("pigz -f -p {} -{} {} || gzip -f -{} {}".format(threads, level, tarname, level, tarname))
+    return output
+
 def make_sure_exists(path, make=False):
     if not os.path.exists(path):
         if not make:
@@ -114,12 +163,23 @@ def make_htcondor_cluster(
         blacklisted_machines=[],
         whitelisted_machines=[],
         tarballpath="/hadoop/cms/store/user/{}/daskenvs/daskworkerenv.tar.gz".format(os.getenv("USER")),
+        env_cache_dir="/tmp/daskenvs_{}".format(os.getenv("USER")),
+        warmup="pdroot",
+        prefork=False,
         ):
+    """
+    Return an HTCondorCluster whose workers run in the conda-packed environment at
+    `tarballpath` (.tar.zst/.tar.lz4/.tar.gz, see `pack_worker_env`). Workers unpack it
+    once per node under `env_cache_dir`, keyed on its content hash (`None` disables the
+    node-local cache), and report their startup phase timings as worker metrics.
+    `warmup` is the cachepreload.py warm-up profile (modules imported in the background at
+    startup), and `prefork=True` forks restarted worker processes from a warm forkserver.
+    """
 
     set_dask_config()
 
     # input_files = [os.path.join(BASEDIR, x) for x in ["utils.py","cachepreload.py","daskworkerenv.tar.gz"]]
-    input_files = [os.path.join(BASEDIR, x) for x in ["utils.py","cachepreload.py"]]
+    input_files = [os.path.join(BASEDIR, x) for x in ["utils.py","cachepreload.py","columnar.py"]]
     log_directory = os.path.join(BASEDIR, "logs/")
     proxy_file = "/tmp/x509up_u{0}".format(os.getuid())
 
@@ -133,6 +193,7 @@ def make_htcondor_cluster(
         extra_requirements = " || ".join(map(lambda x: '(TARGET.Machine == "{0}")'.format(x),whitelisted_machines))
 
     xrdpath = "root://redirector.t2.ucsd.edu//store/{}".format(tarballpath.split("/store/",1)[1])
+    envhash = get_env_hash(tarballpath) if env_cache_dir else ""
 
     params = {
             "disk": disk,
@@ -152,6 +213,8 @@ def make_htcondor_cluster(
                 "JobBatchName": '"daskworker"',
                 "x509userproxy": proxy_file,
                 "+tarballpath":'"{}"'.format(xrdpath),
+                "+envhash":'"{}"'.format(envhash),
+                "+envcachedir":'"{}"'.format(env_cache_dir or ""),
                 "+SingularityImage":'"/cvmfs/singularity.opensciencegrid.org/cmssw/cms:rhel7-m202006"',
                 "Stream_Output": False,
                 "Stream_Error": False,
@@ -160,6 +223,10 @@ def make_htcondor_cluster(
                 },
             "extra": [
                 "--preload", "cachepreload.py",
+                ] + (["--preload-nanny", "cachepreload.py"] if prefork else []),
+            "env_extra": [
+                "DASKUCSD_WARMUP={}".format(warmup),
+                "DASKUCSD_PREFORK={}".format(int(prefork)),
                 ],
             }
     if local:
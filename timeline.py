@@ -0,0 +1,181 @@
+"""
+Timeline/efficiency analysis of `get_results` outputs.
+
+Everything is computed with numpy over the sorted `t_start`/`t_stop` arrays (no
+per-task python loops), and the timeline is rendered as a binned worker x time
+utilization image plus a concurrency curve, so that plots stay light with 50k+ tasks.
+Reports can be exported as static HTML or JSON without a live notebook:
+
+    from timeline import export_report
+    export_report(results, "report.html")
+"""
+
+import json
+
+import numpy as np
+
+def get_task_arrays(results):
+    """
+    Return dict of per-task numpy arrays (t_start/t_stop relative to the first start,
+    integer worker codes, and t_io if the results were profiled) and the worker names
+    """
+    t_start = np.asarray(results["t_start"], dtype=np.float64)
+    t_stop = np.asarray(results["t_stop"], dtype=np.float64)
+    names, worker = np.unique(np.asarray(results["worker_name"], dtype=str), return_inverse=True)
+    t0 = t_start.min() if len(t_start) else 0.
+    arrays = dict(t_start=t_start - t0, t_stop=t_stop - t0, worker=worker.astype(np.int64))
+    if "t_io" in results:
+        arrays["t_io"] = np.asarray(results["t_io"], dtype=np.float64)
+    return arrays, list(names)
+
+def _busy_integral(t_start, t_stop, edges):
+    """
+    Return the total busy time of intervals [t_start, t_stop) up to each of `edges`
+    """
+    starts = np.sort(t_start)
+    stops = np.sort(t_stop)
+    cstarts = np.concatenate([[0.], np.cumsum(starts)])
+    cstops = np.concatenate([[0.], np.cumsum(stops)])
+    nstarted = np.searchsorted(starts, edges, side="right")
+    nstopped = np.searchsorted(stops, edges, side="right")
+    return (nstarted*edges - cstarts[nstarted]) - (nstopped*edges - cstops[nstopped])
+
+def compute_stats(results, tail_fraction=0.95):
+    """
+    Return dict of timeline statistics: efficiency (busy time over wall time times
+    workers), idle gaps between consecutive tasks of a worker, task time quantiles,
+    per-worker busy time/throughput, and the tail duration (wall time after
+    `tail_fraction` of the tasks had finished)
+    """
+    arrays, names = get_task_arrays(results)
+    t_start, t_stop, worker = arrays["t_start"], arrays["t_stop"], arrays["worker"]
+    nworkers = len(names)
+    ntasks = len(t_start)
+    duration = t_stop - t_start
+    wall = t_stop.max() if ntasks else 0.
+
+    order = np.lexsort((t_start, worker))
+    sworker, sstart, sstop = worker[order], t_start[order], t_stop[order]
+    same = sworker[1:] == sworker[:-1]
+    gaps = np.clip(sstart[1:][same] - sstop[:-1][same], 0., None)
+
+    busy = np.bincount(worker, weights=duration, minlength=nworkers)
+    ntasks_worker = np.bincount(worker, minlength=nworkers)
+    group_starts = np.flatnonzero(np.concatenate([[True], ~same])) if ntasks else np.array([], dtype=int)
+    first = np.minimum.reduceat(sstart, group_starts) if ntasks else np.zeros(0)
+    last = np.maximum.reduceat(sstop, group_starts) if ntasks else np.zeros(0)
+    span = last - first
+
+    tail_start = np.quantile(t_stop, tail_fraction) if ntasks else 0.
+    stats = dict(
+        nworkers=nworkers,
+        ntasks=ntasks,
+        wall_time=float(wall),
+        busy_time=float(busy.sum()),
+        efficiency=float(busy.sum()/(wall*nworkers)) if ntasks else 0.,
+        idle_time=float(gaps.sum()),
+        median_task_time=float(np.median(duration)) if ntasks else 0.,
+        p95_task_time=float(np.quantile(duration, 0.95)) if ntasks else 0.,
+        max_task_time=float(duration.max()) if ntasks else 0.,
+        median_intertask_time=float(np.median(gaps)) if len(gaps) else 0.,
+        tail_fraction=tail_fraction,
+        tail_duration=float(wall - tail_start),
+        workers=dict(
+            name=names,
+            ntasks=ntasks_worker.tolist(),
+            busy_time=busy.tolist(),
+            efficiency=(busy/np.where(span > 0, span, 1.)).tolist(),
+            tasks_per_second=(ntasks_worker/np.where(span > 0, span, 1.)).tolist(),
+        ),
+    )
+    if "nevents_processed" in results and ntasks:
+        stats["event_rate"] = float(results["nevents_processed"]/wall) if wall else 0.
+    if "t_io" in arrays:
+        stats["io_fraction"] = float(arrays["t_io"].sum()/busy.sum()) if busy.sum() else 0.
+    return stats
+
+def bin_timeline(results, nbins=200):
+    """
+    Return dict with time bin `edges`, per-worker `utilization` (nworkers x nbins,
+    fraction of each bin a worker was busy) and `concurrency` (mean number of
+    running tasks per bin)
+    """
+    arrays, names = get_task_arrays(results)
+    t_start, t_stop, worker = arrays["t_start"], arrays["t_stop"], arrays["worker"]
+    wall = t_stop.max() if len(t_stop) else 1.
+    edges = np.linspace(0., wall, nbins+1)
+    widths = np.diff(edges)
+    order = np.argsort(worker, kind="stable")
+    bounds = np.searchsorted(worker[order], np.arange(len(names)+1))
+    utilization = np.zeros((len(names), nbins))
+    for i in range(len(names)):
+        sel = order[bounds[i]:bounds[i+1]]
+        utilization[i] = np.diff(_busy_integral(t_start[sel], t_stop[sel], edges))/widths
+    concurrency = np.diff(_busy_integral(t_start, t_stop, edges))/widths
+    return dict(edges=edges, utilization=utilization, concurrency=concurrency, workers=names)
+
+def plot_timeline(results, nbins=200, width=800, height=400):
+    """
+    Return a bokeh layout with the binned worker utilization image and the
+    concurrency curve, titled with the main statistics
+    """
+    from bokeh.layouts import column
+    from bokeh.models import ColorBar, LinearColorMapper
+    from bokeh.plotting import figure
+
+    stats = compute_stats(results)
+    binned = bin_timeline(results, nbins=nbins)
+    wall = binned["edges"][-1]
+    nworkers = len(binned["workers"])
+
+    title = ", ".join([
+        "{} workers".format(nworkers),
+        "{} tasks".format(stats["ntasks"]),
+        "efficiency = {:.1f}%".format(100.0*stats["efficiency"]),
+        "median task time = {:.2f}s".format(stats["median_task_time"]),
+        "median intertask time = {:.2f}s".format(stats["median_intertask_time"]),
+        "tail = {:.1f}s".format(stats["tail_duration"]),
+        ] + (["I/O fraction = {:.1f}%".format(100.0*stats["io_fraction"])] if "io_fraction" in stats else []))
+
+    mapper = LinearColorMapper(palette="Viridis256", low=0., high=1.)
+    p = figure(title=title, x_range=(0, wall), y_range=(-0.5, nworkers-0.5), width=width, height=height)
+    p.image(image=[binned["utilization"]], x=0, y=-0.5, dw=wall, dh=nworkers, color_mapper=mapper)
+    p.add_layout(ColorBar(color_mapper=mapper, title="utilization"), "right")
+    p.xaxis.axis_label = "elapsed time since start (s)"
+    p.yaxis.axis_label = "worker"
+
+    centers = 0.5*(binned["edges"][1:] + binned["edges"][:-1])
+    q = figure(x_range=p.x_range, width=width, height=height//2)
+    q.line(centers, binned["concurrency"], line_width=2)
+    q.xaxis.axis_label = "elapsed time since start (s)"
+    q.yaxis.axis_label = "running tasks"
+    return column(p, q)
+
+def export_report(results, path, nbins=200):
+    """
+    Write a static report to `path`: JSON (statistics and binned timeline) if it
+    ends with .json, otherwise standalone HTML (plots and a statistics table)
+    """
+    stats = compute_stats(results)
+    if path.endswith(".json"):
+        binned = bin_timeline(results, nbins=nbins)
+        report = dict(stats=stats, timeline=dict(
+            edges=binned["edges"].round(4).tolist(),
+            concurrency=binned["concurrency"].round(4).tolist(),
+            utilization=binned["utilization"].round(4).tolist(),
+            ))
+        with open(path, "w") as fh:
+            json.dump(report, fh)
+        return path
+
+    from bokeh.embed import file_html
+    from bokeh.layouts import column
+    from bokeh.models import Div
+    from bokeh.resources import CDN
+
+    rows = "".join("<tr><td>{}</td><td>{:.4g}</td></tr>".format(k, v) for k, v in stats.items() if isinstance(v, (int, float)))
+    table = Div(text="<table>{}</table>".format(rows))
+    html = file_html(column(plot_timeline(results, nbins=nbins), table), CDN, "Timeline report")
+    with open(path, "w") as fh:
+        fh.write(html)
+    return path
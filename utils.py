@@ -1,19 +1,215 @@
+import collections
+import copy
 import functools
+import hashlib
+import itertools
+import json
+import numbers
+import os
+import socket
+import struct
+import sys
+import threading
 import time
-import uproot3
+import zlib
+import numpy as np
 import uproot4
 from tqdm.auto import tqdm
 import concurrent.futures
 from dask.distributed import as_completed, get_client, get_worker
+from distributed.diagnostics.plugin import SchedulerPlugin
 from collections import defaultdict
 import pdroot
+import columnar
+
+DEFAULT_INDEX_PATH = os.getenv("DASKUCSD_INDEX_PATH", os.path.expanduser("~/.daskucsd/chunkindex.sqlite"))
+DEFAULT_CHECKPOINT_PATH = os.getenv("DASKUCSD_CHECKPOINT_PATH", os.path.expanduser("~/.daskucsd/checkpoints.sqlite"))
+
+class ChunkIndex(object):
+    """
+    Persistent sqlite index of per-file tree metadata (entry count, cluster
+    boundaries, compressed bytes), keyed on (filename, treename) and
+    invalidated when the file mtime/size changes.
+    """
+    def __init__(self, path=DEFAULT_INDEX_PATH):
+        import sqlite3
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                filename TEXT, treename TEXT, mtime REAL, size INTEGER,
+                nentries INTEGER, compressed_bytes INTEGER, boundaries TEXT,
+                PRIMARY KEY (filename, treename)
+            )""")
+        self.conn.commit()
+
+    def get(self, fnames, treename="Events"):
+        """
+        Return dict of filename -> metadata for the subset of `fnames`
+        that are in the index and unchanged on disk
+        """
+        fnames = list(fnames)
+        found = dict()
+        for i in range(0, len(fnames), 500):
+            batch = fnames[i:i+500]
+            rows = self.conn.execute(
+                "SELECT filename, mtime, size, nentries, compressed_bytes, boundaries FROM files "
+                "WHERE treename = ? AND filename IN ({})".format(",".join("?"*len(batch))),
+                [treename] + batch,
+            ).fetchall()
+            for fname, mtime, size, nentries, compressed_bytes, boundaries in rows:
+                if (mtime, size) != columnar.stat(fname):
+                    continue
+                found[fname] = dict(
+                    nentries=nentries,
+                    compressed_bytes=compressed_bytes,
+                    boundaries=json.loads(boundaries),
+                )
+        return found
+
+    def put(self, metadata, treename="Events"):
+        """
+        Store dict of filename -> metadata (as returned by `get_file_metadata`)
+        """
+        rows = []
+        for fname, meta in metadata.items():
+            mtime, size = columnar.stat(fname)
+            rows.append((fname, treename, mtime, size, meta["nentries"], meta["compressed_bytes"], json.dumps(meta["boundaries"])))
+        self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)", rows)
+        self.conn.commit()
+
+    def clear(self):
+        self.conn.execute("DELETE FROM files")
+        self.conn.commit()
+
+_file_handles = collections.OrderedDict()
+_file_handles_lock = threading.Lock()
+_scan_executor = None
+
+def _close_handle(handle):
+    try:
+        handle.close()
+    except Exception:
+        pass
+
+def open_file(fname, timeout=None, max_handles=64):
+    """
+    Return an uproot4 file handle for `fname`, reusing one of the (up to `max_handles`)
+    handles already opened by this process if the file's mtime/size haven't changed
+    """
+    stat = columnar.stat(fname)
+    with _file_handles_lock:
+        if fname in _file_handles:
+            handle, old_stat = _file_handles[fname]
+            if old_stat == stat:
+                _file_handles.move_to_end(fname)
+                return handle
+            del _file_handles[fname]
+            _close_handle(handle)
+    options = dict(timeout=timeout) if timeout else dict()
+    handle = uproot4.open(fname, **options)
+    with _file_handles_lock:
+        _file_handles[fname] = (handle, stat)
+        while len(_file_handles) > max_handles:
+            _, (old, _) = _file_handles.popitem(last=False)
+            _close_handle(old)
+    return handle
+
+def forget_file(fname):
+    """
+    Close and drop the cached handle of `fname`, if any
+    """
+    with _file_handles_lock:
+        handle, _ = _file_handles.pop(fname, (None, None))
+    if handle is not None:
+        _close_handle(handle)
+
+def get_scan_executor(workers=12):
+    """
+    Return the process-wide thread pool used for metadata scans, sized with
+    `workers` threads on first use (threads are only started as needed)
+    """
+    global _scan_executor
+    with _file_handles_lock:
+        if _scan_executor is None:
+            _scan_executor = concurrent.futures.ThreadPoolExecutor(workers)
+    return _scan_executor
+
+def get_file_metadata(fname, treename="Events", timeout=None):
+    """
+    Return dict with entry count, common basket boundaries (entry offsets where
+    all branches start a new basket) and total compressed bytes of `treename`
+    """
+    t = open_file(fname, timeout=timeout)[treename]
+    nentries = int(t.num_entries)
+    try:
+        boundaries = [int(x) for x in t.common_entry_offsets()]
+    except Exception:
+        boundaries = [0, nentries]
+    return dict(
+        nentries=nentries,
+        compressed_bytes=int(t.member("fZipBytes")),
+        boundaries=boundaries,
+    )
+
+def classify_error(e):
+    """
+    Return "missing", "timeout", "corrupt" or "other" for an exception raised while opening a file
+    """
+    msg = str(e).lower()
+    if isinstance(e, FileNotFoundError) or "no such file" in msg or "not found" in msg:
+        return "missing"
+    if isinstance(e, (TimeoutError, socket.timeout)) or "timed out" in msg or "timeout" in msg:
+        return "timeout"
+    if isinstance(e, (ValueError, KeyError, IndexError, EOFError, zlib.error, struct.error)) or any(x in msg for x in ["deserializ", "expected chunk", "root file"]):
+        return "corrupt"
+    return "other"
+
+def scan_file(fname, treename="Events", retries=2, timeout=None, backoff=1.):
+    """
+    Return (fname, metadata, error) where error is None or (kind, message).
+    Timeouts and unknown errors are retried `retries` times with exponential backoff,
+    missing and corrupt files are not.
+    """
+    for attempt in range(retries+1):
+        try:
+            return fname, get_file_metadata(fname, treename, timeout=timeout), None
+        except Exception as e:
+            forget_file(fname)
+            kind = classify_error(e)
+            if kind in ("missing", "corrupt") or attempt == retries:
+                return fname, None, (kind, repr(e))
+            time.sleep(backoff * 2**attempt)
+
+def scan_files(fnames, treename="Events", workers=12, retries=2, timeout=None):
+    """
+    Scan a batch of files concurrently on the shared thread pool, returning a list of
+    `scan_file` outputs. Used locally, and as one dask task per batch of files.
+    """
+    executor = get_scan_executor(workers)
+    return list(executor.map(lambda fname: scan_file(fname, treename, retries=retries, timeout=timeout), fnames))
 
 @functools.lru_cache(maxsize=256)
-def get_chunking(filelist, chunksize, treename="Events", workers=12, skip_bad_files=False, xrootd=False, client=None, use_dask=False):
+def get_chunking(filelist, chunksize, treename="Events", workers=12, skip_bad_files=False, xrootd=False, client=None, use_dask=False, index_path=DEFAULT_INDEX_PATH, strategy="entries", target_bytes=None,
+        files_per_task=50, retries=2, timeout=None, columnar_path=columnar.DEFAULT_COLUMNAR_PATH):
     """
     Return 2-tuple of
     - chunks: triplets of (filename,entrystart,entrystop) calculated with input `chunksize` and `filelist`
     - total_nevents: total event count over `filelist`
+
+    With `strategy="baskets"`, chunk edges are aligned to common basket boundaries and
+    chunks are closed once they reach `target_bytes` compressed bytes (or `chunksize` entries
+    if `target_bytes` is None). Small tails are folded into the previous chunk and files smaller
+    than the target are grouped, in which case a chunk is a tuple of triplets (see `iter_chunk_ranges`).
+
+    Per-file metadata is looked up in (and added to) the persistent `ChunkIndex`
+    at `index_path`, so only new or modified files get opened. `index_path=None` disables it.
+    New files are scanned with `scan_files` on a shared pool of `workers` threads, either locally or
+    (`use_dask=True`) with `files_per_task` files per dask task; timeouts are retried `retries` times.
+    Files with a columnar cache under `columnar_path` (see columnar.py), and columnar
+    directories (e.g., skims) given directly, take their entry counts from it instead of being opened.
     """
 
     if xrootd:
@@ -28,70 +224,403 @@ def get_chunking(filelist, chunksize, treename="Events", workers=12, skip_bad_fi
     chunksize = int(chunksize)
     chunks = []
     nevents = 0
-    
-    if use_dask:
+
+    index = ChunkIndex(index_path) if index_path else None
+    metadata = index.get(filelist, treename) if index else dict()
+    missing = [fname for fname in filelist if fname not in metadata]
+    if missing:
+        for fname in missing:
+            meta = columnar.get_file_metadata(fname, treename, columnar_path)
+            if meta is not None:
+                metadata[fname] = meta
+        missing = [fname for fname in missing if fname not in metadata]
+    if index and missing:
+        print(f"Found {len(metadata)} files in index, scanning {len(missing)} new files")
+
+    scanned = []
+    if missing and use_dask:
         if not client:
             client = get_client()
-        def numentries(fname):
-            try:
-                return (fname,uproot3.numentries(fname,treename))
-            except:
-                return (fname,-1)
-        futures = client.map(numentries, filelist)
-        info = []
-        for future, result in tqdm(as_completed(futures, with_results=True), total=len(futures)):
-            info.append(result)
-        for fn, nentries in info:
-            if nentries < 0:
-                if skip_bad_files:
-                    print("Skipping bad file: {}".format(fn))
-                    continue
-                else: raise RuntimeError("Bad file: {}".format(fn))
-            nevents += nentries
-            for index in range(nentries // chunksize + 1):
-                chunks.append((fn, chunksize*index, min(chunksize*(index+1), nentries)))
+        batches = [missing[i:i+files_per_task] for i in range(0, len(missing), files_per_task)]
+        # partial, since `workers` would otherwise be taken by client.map as a worker restriction
+        scan = functools.partial(scan_files, treename=treename, workers=workers, retries=retries, timeout=timeout)
+        futures = client.map(scan, batches, pure=False)
+        bar = tqdm(total=len(missing), unit="files")
+        for future, batch in as_completed(futures, with_results=True):
+            scanned.extend(batch)
+            bar.update(len(batch))
+        bar.close()
+    elif missing:
+        scanned = scan_files(missing, treename, workers=workers, retries=retries, timeout=timeout)
+
+    errors = {fn: error for fn, meta, error in scanned if error is not None}
+    if errors:
+        kinds = collections.Counter(kind for kind, _ in errors.values())
+        print("Failed to read {} files ({})".format(len(errors), ", ".join(f"{n} {kind}" for kind, n in kinds.items())))
+    scanned = {fn: meta for fn, meta, error in scanned}
+    good = {fn: meta for fn, meta in scanned.items() if meta is not None}
+    if index and good:
+        index.put(good, treename)
+    metadata.update(good)
+
+    good_files = []
+    for fn in filelist:
+        if fn not in metadata:
+            kind, msg = errors.get(fn, ("unknown", ""))
+            if skip_bad_files:
+                print("Skipping bad file ({}): {}".format(kind, fn))
+                continue
+            else: raise RuntimeError("Bad file ({}): {} {}".format(kind, fn, msg))
+        good_files.append(fn)
+        nevents += metadata[fn]["nentries"]
+
+    if strategy == "entries":
+        for fn in good_files:
+            nentries = metadata[fn]["nentries"]
+            for ichunk in range((nentries + chunksize - 1) // chunksize):
+                chunks.append((fn, chunksize*ichunk, min(chunksize*(ichunk+1), nentries)))
+    elif strategy == "baskets":
+        chunks = make_basket_chunks(good_files, metadata, chunksize, target_bytes=target_bytes)
     else:
-        if skip_bad_files:
-            # slightly slower (serial loop), but can skip bad files
-            for fname in tqdm(filelist):
-                try:
-                    items = uproot3.numentries(fname, treename, total=False).items()
-                except (IndexError, ValueError) as e:
-                    print("Skipping bad file", fname)
-                    continue
-                for fn, nentries in items:
-                    nevents += nentries
-                    for index in range(nentries // chunksize + 1):
-                        chunks.append((fn, chunksize*index, min(chunksize*(index+1), nentries)))
-        else:
-            executor = None if len(filelist) < 5 else concurrent.futures.ThreadPoolExecutor(min(workers, len(filelist)))
-            for fn, nentries in uproot3.numentries(filelist, treename, total=False, executor=executor).items():
-                nevents += nentries
-                for index in range(nentries // chunksize + 1):
-                    chunks.append((fn, chunksize*index, min(chunksize*(index+1), nentries)))
+        raise ValueError("Unknown chunking strategy: {}".format(strategy))
 
     return chunks, nevents
 
+def make_basket_chunks(filelist, metadata, chunksize, target_bytes=None):
+    """
+    Return list of chunks whose edges lie on the common basket boundaries in `metadata`
+    and whose cost (compressed bytes if `target_bytes` is given, otherwise entries
+    with a target of `chunksize`) is roughly equal. Files cheaper than the target
+    are grouped into multi-file chunks (tuples of triplets).
+    """
+    target = target_bytes or chunksize
+    chunks = []
+    pending, pending_cost = [], 0.
+    for fn in filelist:
+        meta = metadata[fn]
+        nentries = meta["nentries"]
+        if nentries == 0:
+            continue
+        cost_per_entry = (meta["compressed_bytes"] / nentries) if target_bytes else 1.
+        edges = sorted(set(b for b in meta["boundaries"] if 0 < b < nentries) | {0, nentries})
+
+        cuts, acc = [0], 0.
+        for lo, hi in zip(edges[:-1], edges[1:]):
+            acc += (hi - lo) * cost_per_entry
+            if acc >= target:
+                cuts.append(hi)
+                acc = 0.
+        if cuts[-1] != nentries:
+            if len(cuts) > 1 and acc < 0.5 * target:
+                cuts[-1] = nentries
+            else:
+                cuts.append(nentries)
+
+        if len(cuts) == 2 and nentries * cost_per_entry < target:
+            pending.append((fn, 0, nentries))
+            pending_cost += nentries * cost_per_entry
+            if pending_cost >= target:
+                chunks.append(tuple(pending) if len(pending) > 1 else pending[0])
+                pending, pending_cost = [], 0.
+            continue
+
+        for lo, hi in zip(cuts[:-1], cuts[1:]):
+            chunks.append((fn, lo, hi))
+
+    if pending:
+        chunks.append(tuple(pending) if len(pending) > 1 else pending[0])
+    return chunks
+
+def iter_chunk_ranges(chunk):
+    """
+    Yield (filename,entrystart,entrystop) triplets of a chunk, which is either
+    a single triplet or a tuple of them (grouped small files)
+    """
+    if isinstance(chunk[0], (tuple, list)):
+        for subchunk in chunk:
+            yield tuple(subchunk)
+    else:
+        yield tuple(chunk)
+
+
+_type_mergers = []
+_key_mergers = dict()
+
+def register_merger(func, types=None, keys=None):
+    """
+    Register `func`, which takes a list of values and returns their merged value,
+    as the strategy used by `combine_dicts` for values of `types` (checked with
+    isinstance, most recently registered first) and/or for the dictionary `keys`
+    (which take precedence over types)
+    """
+    if types is not None:
+        _type_mergers.insert(0, (types, func))
+    for key in ([keys] if isinstance(keys, str) else (keys or [])):
+        _key_mergers[key] = func
+
+def get_merger(key, value):
+    if key in _key_mergers:
+        return _key_mergers[key]
+    for types, func in _type_mergers:
+        if isinstance(value, types):
+            return func
+    return merge_iadd
+
+def merge_iadd(values):
+    out = values[0]
+    for v in values[1:]:
+        out += v
+    return out
+
+def merge_numbers(values):
+    return sum(values)
+
+def merge_lists(values):
+    return list(itertools.chain.from_iterable(values))
+
+def merge_counters(values):
+    out = collections.Counter()
+    for v in values:
+        out.update(v)
+    return out
+
+def merge_arrays(values, batch_size=64):
+    """
+    Sum a list of same-shape arrays, stacking up to `batch_size` of them at a time
+    into one preallocated buffer and reducing each stack with a single `np.sum`
+    """
+    first = np.asarray(values[0])
+    if len(values) == 1:
+        return first.copy()
+    if any(np.shape(v) != first.shape for v in values):
+        return merge_iadd([first.copy()] + list(values[1:]))
+    dtype = np.result_type(*set(np.asarray(v).dtype for v in values))
+    if dtype == np.bool_:
+        return merge_iadd([first.copy()] + list(values[1:]))
+    out = np.zeros(first.shape, dtype=dtype)
+    buf = np.empty((min(batch_size, len(values)),) + first.shape, dtype=dtype)
+    for i in range(0, len(values), batch_size):
+        batch = values[i:i+batch_size]
+        for j, v in enumerate(batch):
+            buf[j] = v
+        out += np.sum(buf[:len(batch)], axis=0)
+    return out
+
+def merge_hists(values):
+    """
+    Merge yahist Hist1D/Hist2D objects with identical binning by summing
+    counts and adding errors in quadrature, in one pass per array (otherwise
+    fall back to `+=`, which raises for incompatible binning)
+    """
+    first = values[0]
+    def same_edges(v):
+        if isinstance(first._edges, tuple):
+            return len(v._edges) == len(first._edges) and all(np.array_equal(a, b) for a, b in zip(v._edges, first._edges))
+        return np.array_equal(v._edges, first._edges)
+    if any(type(v) is not type(first) or np.shape(v._counts) != np.shape(first._counts) or not same_edges(v) for v in values):
+        return merge_iadd([first.copy()] + list(values[1:]))
+    out = first.copy()
+    out._counts = merge_arrays([v._counts for v in values])
+    out._errors = np.sqrt(merge_arrays([v._errors**2 for v in values]))
+    return out
 
 def combine_dicts(dicts):
-    new_dict = dict()
+    """
+    Merge a list of result dicts key by key, gathering all values of a key
+    and merging them in one call with the strategy from `register_merger`
+    (additive for numbers/arrays/histograms/counters, concatenation for lists,
+    `+=` otherwise)
+    """
+    dicts = list(dicts)
+    if dicts and isinstance(dicts[0], ChunkResult):
+        return ChunkResult.merge(dicts)
+    values = dict()
     for d in dicts:
         for k,v in d.items():
-            if k not in new_dict:
-                new_dict[k] = v
+            if k not in values:
+                values[k] = [v]
             else:
-                new_dict[k] += v
+                values[k].append(v)
+    new_dict = dict()
+    for k, vs in values.items():
+        if len(vs) == 1:
+            new_dict[k] = vs[0]
+        else:
+            new_dict[k] = get_merger(k, vs[0])(vs)
     return new_dict
 
+register_merger(merge_numbers, types=numbers.Number)
+register_merger(merge_lists, types=list)
+register_merger(merge_arrays, types=np.ndarray)
+register_merger(combine_dicts, types=dict)
+# after dict, since Counter is a dict subclass and later registrations are checked first
+register_merger(merge_counters, types=collections.Counter)
+try:
+    from yahist import Hist1D, Hist2D
+    register_merger(merge_hists, types=(Hist1D, Hist2D))
+except ImportError:
+    pass
+
+_hist_types = ()
+try:
+    from yahist import Hist1D, Hist2D
+    _hist_types = (Hist1D, Hist2D)
+except ImportError:
+    pass
+
+class ChunkResult(object):
+    """
+    Compact result container for a chunk (or a merge of chunks). Numpy arrays, including
+    the ones inside yahist histograms, are kept as contiguous buffers described by a small
+    schema, and per-task timing metadata lives in one fixed-width structured array instead
+    of growing python lists. A dask serializer sends the buffers as out-of-band frames, so
+    they are not copied into a pickle stream between workers, reducers and the client.
+
+    Reads like the plain result dict (`result["hmet"]`, `result["t_start"]`, ...);
+    `to_dict()` converts to it.
+    """
+    timing_dtype = np.dtype([("t_start", "f8"), ("t_stop", "f8"), ("nevents", "i8"), ("worker", "i4")])
+
+    def __init__(self, values=None, timing=None, workers=None):
+        self.values = values if values is not None else dict()
+        self.timing = timing if timing is not None else np.zeros(0, dtype=self.timing_dtype)
+        self.workers = workers if workers is not None else []
+
+    @classmethod
+    def from_output(cls, out, t_start, t_stop, nevents, worker_name):
+        timing = np.array([(t_start, t_stop, nevents, 0)], dtype=cls.timing_dtype)
+        return cls(dict(out), timing, [worker_name])
+
+    @classmethod
+    def merge(cls, results):
+        results = list(results)
+        worker_index = dict()
+        timings = []
+        for result in results:
+            timing = result.timing.copy()
+            remap = np.array([worker_index.setdefault(w, len(worker_index)) for w in result.workers], dtype=np.int32)
+            if len(timing):
+                timing["worker"] = remap[timing["worker"]]
+            timings.append(timing)
+        workers = sorted(worker_index, key=worker_index.get)
+        values = combine_dicts([result.values for result in results])
+        return cls(values, np.concatenate(timings) if timings else None, workers)
+
+    def __getitem__(self, key):
+        if key == "nevents_processed":
+            return int(self.timing["nevents"].sum())
+        if key in ("t_start", "t_stop"):
+            return self.timing[key].tolist()
+        if key == "worker_name":
+            return [self.workers[i] for i in self.timing["worker"]]
+        return self.values[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return list(self.values.keys()) + ["nevents_processed", "t_start", "t_stop", "worker_name"]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def to_frames(self):
+        """
+        Return (header, frames) where frames are memoryviews of the contiguous
+        numpy buffers (zero-copy) and one pickle of the remaining python values
+        """
+        import pickle
+        header = dict(workers=self.workers, entries=[])
+        frames = [None, np.ascontiguousarray(self.timing).reshape(-1).view(np.uint8).data]
+        def add_array(array):
+            array = np.ascontiguousarray(array)
+            frames.append(array.reshape(-1).view(np.uint8).data)
+            return [array.dtype.str, list(array.shape)]
+        rest = dict()
+        for key, value in self.values.items():
+            if isinstance(value, np.ndarray) and value.dtype.kind in "biufc":
+                header["entries"].append(["array", key, add_array(value)])
+            elif _hist_types and isinstance(value, _hist_types):
+                attrs = dict(value.__dict__)
+                array_attrs = []
+                for name, attr in list(attrs.items()):
+                    if isinstance(attr, np.ndarray) and attr.dtype.kind in "biufc":
+                        array_attrs.append([name, False, [add_array(attr)]])
+                        del attrs[name]
+                    elif isinstance(attr, tuple) and attr and all(isinstance(a, np.ndarray) for a in attr):
+                        array_attrs.append([name, True, [add_array(a) for a in attr]])
+                        del attrs[name]
+                header["entries"].append(["object", key, array_attrs])
+                rest[key] = (type(value), attrs)
+            else:
+                rest[key] = value
+        frames[0] = pickle.dumps(rest, protocol=pickle.HIGHEST_PROTOCOL)
+        return header, frames
+
+    @classmethod
+    def from_frames(cls, header, frames):
+        import pickle
+        rest = pickle.loads(frames[0])
+        timing = np.frombuffer(frames[1], dtype=cls.timing_dtype)
+        iframe = iter(frames[2:])
+        def next_array(spec):
+            dtype, shape = spec
+            return np.frombuffer(next(iframe), dtype=np.dtype(dtype)).reshape(shape)
+        values = dict()
+        for kind, key, spec in header["entries"]:
+            if kind == "array":
+                values[key] = next_array(spec)
+                continue
+            typ, attrs = rest.pop(key)
+            obj = typ.__new__(typ)
+            obj.__dict__.update(attrs)
+            for name, is_tuple, specs in spec:
+                arrays = [next_array(spec) for spec in specs]
+                setattr(obj, name, tuple(arrays) if is_tuple else arrays[0])
+            values[key] = obj
+        values.update(rest)
+        return cls(values, timing, list(header["workers"]))
+
+try:
+    from distributed.protocol import dask_serialize, dask_deserialize
+
+    @dask_serialize.register(ChunkResult)
+    def serialize_chunk_result(result):
+        return result.to_frames()
+
+    @dask_deserialize.register(ChunkResult)
+    def deserialize_chunk_result(header, frames):
+        return ChunkResult.from_frames(header, frames)
+except ImportError:
+    pass
+
 def clear_tree_cache(client=None):
     if not client:
         client = get_client()
-    def f():
-        worker = get_worker()
+    def f(dask_worker):
+        worker = dask_worker
         if hasattr(worker, "tree_cache"):
             worker.tree_cache.clear()
     client.run(f)
 
+def clear_array_cache(client=None):
+    if not client:
+        client = get_client()
+    def f(dask_worker):
+        worker = dask_worker
+        if hasattr(worker, "array_cache"):
+            worker.array_cache.clear()
+    client.run(f)
+
 def register_yahist_with_dask():
     """
     Register classes with dask so that it can serialize the underlying
@@ -104,53 +633,876 @@ def register_yahist_with_dask():
         pass
 
 
-def get_results(func, fnames, chunksize=250e3, client=None, use_tree_cache=False, skip_bad_files=False, skip_tail_fraction=1.0, wrap_func=True):
+def chunk_nevents(chunk):
+    return sum(stop - start for _, start, stop in iter_chunk_ranges(chunk))
+
+def reduce_on_workers(futures, client=None, fan_in=8, reducer=None, nevents=None, bar=None, skip_tail_fraction=1.0):
+    """
+    Tree-reduce result dicts of `futures` on the workers as they complete, submitting
+    `reducer` (default `combine_dicts`) over groups of up to `fan_in` finished futures,
+    and return only the final merged dict. At most `fan_in` unreduced results are
+    referenced per reduction, so memory stays bounded. `nevents` (list parallel to
+    `futures`) is used to advance `bar` without pulling results to the client.
+    """
+    if not client:
+        client = get_client()
+    if reducer is None:
+        reducer = combine_dicts
+    leaf_nevents = dict(zip([f.key for f in futures], nevents or [0]*len(futures)))
+    ac = as_completed(futures)
+    pending = []
+    ndone = 0
+    skipped_tail = False
+    for future in ac:
+        if skipped_tail and future.status == "cancelled":
+            continue
+        if future.key in leaf_nevents:
+            ndone += 1
+            if bar is not None:
+                bar.update(leaf_nevents[future.key])
+            if (skip_tail_fraction < 1.0) and (1.0*ndone/len(futures) >= skip_tail_fraction) and (ndone < len(futures)):
+                print(f"Reached {100*skip_tail_fraction:.1f}% completion. Ignoring tail tasks")
+                client.cancel([f for f in futures if not f.done()], force=True)
+                skipped_tail = True
+                skip_tail_fraction = 1.0
+        pending.append(future)
+        if (len(pending) >= fan_in) or (ac.count() == 0 and len(pending) > 1):
+            ac.add(client.submit(reducer, pending, pure=False))
+            pending = []
+    if not pending:
+        return dict()
+    if len(pending) > 1:
+        return client.submit(reducer, pending, pure=False).result()
+    return pending[0].result()
+
+def get_cache_affinity(chunks, client=None, max_imbalance=1.5):
+    """
+    Return list (parallel to `chunks`) of preferred worker addresses (or None).
+    Workers are scored per chunk by the number of its branch arrays they hold in
+    `array_cache` for the exact entry ranges, with an open tree in `tree_cache`
+    as a tiebreak. Chunks are spread over equally good workers, and a worker
+    gets no more preferred chunks than `max_imbalance` times its fair share.
+    """
     if not client:
         client = get_client()
+    def f(dask_worker):
+        worker = dask_worker
+        ranges = collections.Counter()
+        if hasattr(worker, "array_cache"):
+            for filename, treename, branch, start, stop in worker.array_cache.keys():
+                ranges[(filename, start, stop)] += 1
+        files = list(worker.tree_cache.keys()) if hasattr(worker, "tree_cache") else []
+        return list(ranges.items()), files
+    worker_ranges = dict()
+    worker_files = dict()
+    for worker, (ranges, files) in client.run(f).items():
+        worker_ranges[worker] = dict(ranges)
+        worker_files[worker] = set(files)
+    if not worker_ranges:
+        return [None]*len(chunks)
+
+    max_per_worker = max_imbalance * len(chunks) / len(worker_ranges)
+    nassigned = collections.Counter()
+    preferred = []
+    for chunk in chunks:
+        scores = collections.Counter()
+        for fname, start, stop in iter_chunk_ranges(chunk):
+            for worker in worker_ranges:
+                scores[worker] += worker_ranges[worker].get((fname, start, stop), 0)
+                scores[worker] += 0.5*(fname in worker_files[worker])
+        best = max(scores.values()) if scores else 0
+        candidates = [w for w, score in scores.items() if score == best and nassigned[w] < max_per_worker]
+        if best <= 0 or not candidates:
+            preferred.append(None)
+            continue
+        worker = min(candidates, key=lambda w: nassigned[w])
+        nassigned[worker] += 1
+        preferred.append(worker)
+    return preferred
+
+def map_with_preferences(process, chunks, preferred, client=None):
+    """
+    Like `client.map(process, chunks)` but with each chunk loosely restricted to
+    its preferred worker, so the scheduler can still steal/balance work
+    """
+    if not client:
+        client = get_client()
+    futures = [None]*len(chunks)
+    groups = defaultdict(list)
+    for i, worker in enumerate(preferred):
+        groups[worker].append(i)
+    for worker, idxs in groups.items():
+        group_futures = client.map(process, [chunks[i] for i in idxs],
+                workers=[worker] if worker else None, allow_other_workers=bool(worker), pure=False)
+        for i, future in zip(idxs, group_futures):
+            futures[i] = future
+    return futures
+
+def speculative_batches(process, chunks, futures, client=None, start_fraction=0.9, slowness=3.0, poll_interval=2.0):
+    """
+    Yield batches of (future, result) for `futures` (parallel to `chunks`) like
+    `as_completed(futures, with_results=True).batches()`. Once `start_fraction` of the
+    chunks are done, chunks that have been in flight for more than `slowness` times the
+    median task time get one duplicate task on another worker; whichever copy finishes
+    first is yielded and the other one is cancelled. In-flight times are tracked from the
+    first poll that sees a task processing on its worker, from the start of the run, so
+    tasks that were already slow before `start_fraction` are duplicated right away.
+    """
+    if not client:
+        client = get_client()
+    key_to_index = {f.key: i for i, f in enumerate(futures)}
+    copies = {i: [f] for i, f in enumerate(futures)}
+    done = set()
+    durations = []
+    first_seen = dict()
+    nspeculated = nwon = 0
+    t_last_check = 0.
+    ac = as_completed(futures, with_results=True)
+    try:
+        while not ac.is_empty():
+            batch = []
+            for future, result in ac.next_batch(block=False):
+                i = key_to_index[future.key]
+                if i in done:
+                    continue
+                done.add(i)
+                others = [f for f in copies.pop(i) if f.key != future.key]
+                if others:
+                    client.cancel(others, force=True)
+                if future is not futures[i]:
+                    nwon += 1
+                if hasattr(result, "get") and result.get("t_start"):
+                    durations.append(sum(result["t_stop"]) - sum(result["t_start"]))
+                elif future.key in first_seen:
+                    durations.append(time.time() - first_seen[future.key][0])
+                batch.append((future, result))
+            if batch:
+                yield batch
+                continue
+            time.sleep(0.1)
+
+            now = time.time()
+            if now - t_last_check < poll_interval:
+                continue
+            t_last_check = now
+            processing = client.processing()
+            for worker, keys in processing.items():
+                for key in keys:
+                    # (re)start the clock when a task shows up on a worker, e.g., after being stolen
+                    if key in key_to_index and first_seen.get(key, (None, None))[1] != worker:
+                        first_seen[key] = (now, worker)
+            if (len(done) < start_fraction*len(futures)) or not durations:
+                continue
+            threshold = slowness*np.median(durations)
+            all_workers = list(client.scheduler_info()["workers"])
+            for worker, keys in processing.items():
+                for key in keys:
+                    if key not in key_to_index:
+                        continue
+                    i = key_to_index[key]
+                    if (i in done) or (len(copies.get(i, [])) > 1) or (now - first_seen[key][0] < threshold):
+                        continue
+                    other_workers = [w for w in all_workers if w != worker]
+                    if not other_workers:
+                        continue
+                    duplicate = client.submit(process, chunks[i], pure=False, workers=other_workers)
+                    key_to_index[duplicate.key] = i
+                    copies[i].append(duplicate)
+                    ac.add(duplicate)
+                    nspeculated += 1
+    finally:
+        leftover = [f for fs in copies.values() for f in fs]
+        if leftover:
+            client.cancel(leftover, force=True)
+        if nspeculated:
+            print(f"Launched {nspeculated} speculative tasks, of which {nwon} finished first")
+
+def adaptive_batches(process, chunks, client=None, target_task_time=20., max_inflight=None, smoothing=0.2,
+        min_chunksize=100, futures=None):
+    """
+    Yield batches of (future, result) while cutting chunks on the fly from the entry
+    ranges covered by `chunks`. A calibration wave of one `chunks`-sized task per worker
+    measures events/s per task (from t_start/t_stop), then subsequent chunks are sized to
+    take `target_task_time` seconds, with the rate estimate updated (exponentially
+    smoothed) as results come in. Chunks never exceed a fair per-worker share of the
+    remaining entries, so the tail shrinks. Submitted futures are appended to `futures`.
+    """
+    if not client:
+        client = get_client()
+    if futures is None:
+        futures = []
+    ranges = collections.deque()
+    for chunk in chunks:
+        for fname, start, stop in iter_chunk_ranges(chunk):
+            if ranges and ranges[-1][0] == fname and ranges[-1][2] == start:
+                ranges[-1] = (fname, ranges[-1][1], stop)
+            elif stop > start:
+                ranges.append((fname, start, stop))
+    nleft = sum(stop - start for _, start, stop in ranges)
+    nworkers = max(len(client.scheduler_info()["workers"]), 1)
+    max_inflight = max_inflight or 2*nworkers
+    chunksize = chunk_nevents(chunks[0]) if chunks else min_chunksize
+    rate = None
+    calibration_rates = []
+    submit_times = dict()
+    ac = as_completed([], with_results=True)
+
+    def submit(size):
+        nonlocal nleft
+        size = int(max(min_chunksize, min(size, np.ceil(nleft / nworkers))))
+        fname, start, stop = ranges[0]
+        end = min(stop, start + size)
+        if end == stop:
+            ranges.popleft()
+        else:
+            ranges[0] = (fname, end, stop)
+        nleft -= end - start
+        future = client.submit(process, (fname, start, end), pure=False)
+        submit_times[future.key] = time.time()
+        futures.append(future)
+        ac.add(future)
+
+    for _ in range(nworkers):
+        if ranges:
+            submit(chunksize)
+
+    ninflight = ac.count()
+    try:
+        for future, result in ac:
+            ninflight -= 1
+            nevents = result["nevents_processed"]
+            if hasattr(result, "get") and result.get("t_start"):
+                duration = sum(result["t_stop"]) - sum(result["t_start"])
+            else:
+                duration = time.time() - submit_times[future.key]
+            task_rate = nevents / max(duration, 1e-3)
+            if rate is None:
+                calibration_rates.append(task_rate)
+                if len(calibration_rates) >= max(1, nworkers // 2):
+                    rate = float(np.median(calibration_rates))
+            else:
+                rate = (1 - smoothing) * rate + smoothing * task_rate
+            yield [(future, result)]
+            while ranges and (rate is not None) and (ninflight < max_inflight):
+                chunksize = rate * target_task_time
+                submit(chunksize)
+                ninflight += 1
+            if ranges and ninflight == 0:
+                submit(chunksize)
+                ninflight += 1
+    finally:
+        client.cancel([f for f in futures if not f.done()], force=True)
+        print(f"Adaptive chunking: {len(futures)} tasks, last chunk size {int(chunksize)} events")
+
+class CheckpointStore(object):
+    """
+    Persistent sqlite store of partially merged results, keyed on a function
+    fingerprint. Each saved partial records the (filename, entry_start, entry_stop)
+    ranges it covers, so a rerun only needs to process the ranges not covered yet.
+    """
+    def __init__(self, path=DEFAULT_CHECKPOINT_PATH):
+        import sqlite3
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS partials (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, fingerprint TEXT,
+                nevents INTEGER, created REAL, result BLOB
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ranges (
+                fingerprint TEXT, filename TEXT, entry_start INTEGER, entry_stop INTEGER,
+                partial_id INTEGER
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ranges_fingerprint ON ranges (fingerprint)")
+        self.conn.commit()
+
+    def save(self, fingerprint, result):
+        """
+        Store a (merged) result, whose "chunk_ranges" list says which entries it covers
+        """
+        if isinstance(result, ChunkResult):
+            result = result.to_dict()
+        with self.conn:
+            self._insert(fingerprint, result)
+
+    def _insert(self, fingerprint, result):
+        import pickle
+        result = dict(result)
+        ranges = result.pop("chunk_ranges", [])
+        cursor = self.conn.execute(
+            "INSERT INTO partials (fingerprint, nevents, created, result) VALUES (?,?,?,?)",
+            (fingerprint, int(result.get("nevents_processed", 0)), time.time(),
+                pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)))
+        self.conn.executemany("INSERT INTO ranges VALUES (?,?,?,?,?)",
+            [(fingerprint, fname, int(start), int(stop), cursor.lastrowid) for fname, start, stop in ranges])
+
+    def load(self, fingerprint):
+        """
+        Return the list of stored partial results for `fingerprint`
+        """
+        import pickle
+        rows = self.conn.execute("SELECT result FROM partials WHERE fingerprint = ? ORDER BY id", (fingerprint,)).fetchall()
+        return [pickle.loads(row[0]) for row in rows]
+
+    def done_ranges(self, fingerprint):
+        """
+        Return dict of filename -> sorted list of merged [entry_start, entry_stop) intervals
+        already covered for `fingerprint`
+        """
+        rows = self.conn.execute(
+            "SELECT filename, entry_start, entry_stop FROM ranges WHERE fingerprint = ? ORDER BY filename, entry_start",
+            (fingerprint,)).fetchall()
+        done = defaultdict(list)
+        for fname, start, stop in rows:
+            intervals = done[fname]
+            if intervals and start <= intervals[-1][1]:
+                intervals[-1][1] = max(intervals[-1][1], stop)
+            else:
+                intervals.append([start, stop])
+        return dict(done)
+
+    def compact(self, fingerprint):
+        """
+        Merge all partials of `fingerprint` into one
+        """
+        partials = self.load(fingerprint)
+        if len(partials) < 2:
+            return
+        rows = self.conn.execute("SELECT filename, entry_start, entry_stop FROM ranges WHERE fingerprint = ?", (fingerprint,)).fetchall()
+        merged = combine_dicts(partials)
+        merged["chunk_ranges"] = rows
+        # in one transaction, so an interrupted compaction can't lose the saved partials
+        with self.conn:
+            self.conn.execute("DELETE FROM partials WHERE fingerprint = ?", (fingerprint,))
+            self.conn.execute("DELETE FROM ranges WHERE fingerprint = ?", (fingerprint,))
+            self._insert(fingerprint, merged)
+
+    def clear(self, fingerprint=None):
+        with self.conn:
+            if fingerprint is None:
+                self.conn.execute("DELETE FROM partials")
+                self.conn.execute("DELETE FROM ranges")
+            else:
+                self.conn.execute("DELETE FROM partials WHERE fingerprint = ?", (fingerprint,))
+                self.conn.execute("DELETE FROM ranges WHERE fingerprint = ?", (fingerprint,))
+
+def remaining_chunks(chunks, done):
+    """
+    Return `chunks` with the entry ranges in `done` (as returned by
+    `CheckpointStore.done_ranges`) cut out. Fully covered chunks are dropped and
+    partially covered ones keep only their uncovered pieces.
+    """
+    new_chunks = []
+    for chunk in chunks:
+        pieces = []
+        for fname, start, stop in iter_chunk_ranges(chunk):
+            for done_start, done_stop in done.get(fname, []):
+                if done_stop <= start or done_start >= stop:
+                    continue
+                if done_start > start:
+                    pieces.append((fname, start, done_start))
+                start = max(start, done_stop)
+                if start >= stop:
+                    break
+            if start < stop:
+                pieces.append((fname, start, stop))
+        if not pieces:
+            continue
+        if pieces == list(iter_chunk_ranges(chunk)):
+            new_chunks.append(chunk)
+        else:
+            new_chunks.append(tuple(pieces) if len(pieces) > 1 else pieces[0])
+    return new_chunks
+
+def _state_token(value, _seen):
+    """
+    Return a string identifying `value` by content, or raise TypeError if it can't
+    """
+    import types
+    if value is None or isinstance(value, (bool, numbers.Number, str, bytes)):
+        return repr(value)
+    if isinstance(value, types.ModuleType):
+        return "module:" + value.__name__
+    if isinstance(value, type):
+        return "type:{}.{}".format(value.__module__, value.__qualname__)
+    if isinstance(value, (tuple, list)):
+        return "{}({})".format(type(value).__name__, ",".join(_state_token(v, _seen) for v in value))
+    if isinstance(value, (set, frozenset)):
+        return "set({})".format(",".join(sorted(_state_token(v, _seen) for v in value)))
+    if isinstance(value, dict):
+        return "dict({})".format(",".join(sorted("{}:{}".format(_state_token(k, _seen), _state_token(v, _seen)) for k, v in value.items())))
+    if isinstance(value, np.ndarray):
+        return "array:{}:{}:{}".format(value.dtype.str, value.shape, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (types.BuiltinFunctionType, np.ufunc)):
+        return "builtin:{}.{}".format(getattr(value, "__module__", None), value.__name__)
+    if callable(value) and (hasattr(value, "__code__") or hasattr(value, "funcs")):
+        return "func:" + get_func_state_fingerprint(value, _seen)
+    if isinstance(value, functools.partial):
+        return "partial({},{},{})".format(_state_token(value.func, _seen), _state_token(value.args, _seen), _state_token(value.keywords, _seen))
+    if callable(value) and hasattr(value, "__dict__"):
+        return "callable:" + get_func_state_fingerprint(value, _seen)
+    raise TypeError(f"cannot fingerprint {type(value).__name__} object")
+
+def get_func_state_fingerprint(func, _seen=None):
+    """
+    Return a hash of `func` like `get_func_fingerprint`, but also of the values of its
+    closure variables and of the globals it uses, so that e.g. changing a cut defined
+    outside `func` changes the hash. Functions they refer to are followed if defined in
+    the same module (otherwise only their code is hashed), and private `_names` are
+    left out as implementation state. Partials are hashed with their arguments, bound
+    methods and callable objects with their instance attributes. Raises TypeError if a
+    value (or `func` itself) can't be hashed by content.
+    """
+    import types
+    _seen = _seen if _seen is not None else set()
+    def digest(token):
+        return hashlib.sha1(token.encode()).hexdigest()[:16]
+    if getattr(func, "funcs", None) is not None:
+        return digest(repr(sorted((name, get_func_state_fingerprint(f, _seen)) for name, f in func.funcs.items())))
+    if isinstance(func, functools.partial):
+        return digest(_state_token(func, _seen))
+    if isinstance(func, types.MethodType):
+        owner = func.__self__
+        owner_state = _state_token(owner if isinstance(owner, type) else vars(owner), _seen) if (isinstance(owner, type) or hasattr(owner, "__dict__")) else None
+        if owner_state is None:
+            raise TypeError(f"cannot fingerprint method of {type(owner).__name__} object")
+        return digest("method:{}:{}".format(get_func_state_fingerprint(func.__func__, _seen), owner_state))
+    code = getattr(func, "__code__", None)
+    if code is None:
+        call = getattr(type(func), "__call__", None)
+        if not hasattr(call, "__code__") or not hasattr(func, "__dict__"):
+            raise TypeError(f"cannot fingerprint {type(func).__name__} callable")
+        return digest("callable:{}.{}:{}:{}".format(type(func).__module__, type(func).__qualname__,
+            get_func_state_fingerprint(call, _seen), _state_token(vars(func), _seen)))
+    if id(code) in _seen:
+        return get_func_fingerprint(func)
+    _seen.add(id(code))
+    h = hashlib.sha1(get_func_fingerprint(func).encode())
+    names = set()
+    codes = [code]
+    while codes:
+        c = codes.pop()
+        names.update(c.co_names)
+        codes.extend(const for const in c.co_consts if hasattr(const, "co_code"))
+    fglobals = getattr(func, "__globals__", dict())
+    state = []
+    for name in sorted(names):
+        if name not in fglobals or name.startswith("_"):
+            continue
+        value = fglobals[name]
+        if hasattr(value, "__code__") and getattr(value, "__module__", None) != func.__module__:
+            value = get_func_fingerprint(value)
+        state.append((name, value))
+    state += list(zip(code.co_freevars, (cell.cell_contents for cell in (func.__closure__ or ()))))
+    state.append(("__defaults__", func.__defaults__))
+    state.append(("__kwdefaults__", func.__kwdefaults__))
+    for name, value in state:
+        try:
+            token = _state_token(value, _seen)
+        except TypeError as e:
+            raise TypeError(f"{name!r} used by {func.__qualname__}: {e}")
+        h.update("{}={};".format(name, token).encode())
+    return h.hexdigest()[:16]
+
+def get_checkpoint_key(func, **params):
+    """
+    Return the checkpoint key for running `func` with `params` (e.g., chunksize),
+    from `get_func_state_fingerprint`. Raises ValueError if `func` depends on values
+    that can't be hashed, in which case an explicit `checkpoint_key` is needed.
+    """
+    try:
+        fingerprint = get_func_state_fingerprint(func)
+    except TypeError as e:
+        raise ValueError(f"Can't derive a checkpoint key from the state of {getattr(func, '__qualname__', func)!r} ({e}). "
+                "Pass `checkpoint_key` explicitly (and change it when the analysis changes).")
+    return hashlib.sha1(repr((fingerprint, sorted(params.items()))).encode()).hexdigest()[:16]
+
+def record_chunk_ranges(process):
+    """
+    Wrap a chunk processing function so that its result carries the entry ranges
+    it covers under "chunk_ranges" (merged by concatenation), for checkpointing
+    """
+    @functools.wraps(process)
+    def wrapper(chunk):
+        result = process(chunk)
+        ranges = list(iter_chunk_ranges(chunk))
+        if isinstance(result, ChunkResult):
+            result.values["chunk_ranges"] = ranges
+        else:
+            result["chunk_ranges"] = ranges
+        return result
+    return wrapper
+
+def scale_result(result, factor, skip=("nevents_processed", "t_start", "t_stop", "worker_name", "chunk_ranges",
+        "profile", "t_io")):
+    """
+    Return a copy of a result dict with numbers, numeric arrays and histograms multiplied
+    by `factor` (recursing into dicts), leaving the bookkeeping keys in `skip` alone
+    """
+    out = dict()
+    for key, value in result.items():
+        if key in skip or isinstance(value, bool):
+            out[key] = value
+        elif isinstance(value, dict):
+            out[key] = scale_result(value, factor, skip=skip)
+        elif isinstance(value, numbers.Number) or (isinstance(value, np.ndarray) and value.dtype.kind in "iufc"):
+            out[key] = value*factor
+        elif _hist_types and isinstance(value, _hist_types):
+            out[key] = value*factor
+        else:
+            out[key] = value
+    return out
+
+def make_snapshot(result, nevents_total):
+    """
+    Return a partial (merged) result scaled up by total/processed events, with the
+    processed fraction under "snapshot_fraction"
+    """
+    if isinstance(result, ChunkResult):
+        result = result.to_dict()
+    nevents = result.get("nevents_processed", 0)
+    snapshot = scale_result(result, 1.0*nevents_total/max(nevents, 1))
+    snapshot["snapshot_fraction"] = 1.0*nevents/max(nevents_total, 1)
+    return snapshot
+
+def get_func_modules(func, _seen=None):
+    """
+    Return sorted names of the (non-builtin) modules that `func` uses through its
+    globals, following functions it calls from the same globals
+    """
+    import types
+    _seen = _seen if _seen is not None else set()
+    if getattr(func, "funcs", None) is not None:
+        return sorted(set(m for f in func.funcs.values() for m in get_func_modules(f, _seen)))
+    code = getattr(func, "__code__", None)
+    if code is None or code in _seen:
+        return []
+    _seen.add(code)
+    names = set()
+    codes = [code]
+    while codes:
+        c = codes.pop()
+        names.update(c.co_names)
+        codes.extend(const for const in c.co_consts if hasattr(const, "co_code"))
+    modules = set()
+    for name in names:
+        value = func.__globals__.get(name)
+        if isinstance(value, types.ModuleType):
+            modules.add(value.__name__)
+        elif isinstance(value, types.FunctionType):
+            modules.add(value.__module__)
+            modules.update(get_func_modules(value, _seen))
+        elif getattr(value, "__module__", None):
+            modules.add(value.__module__)
+    return sorted(m for m in modules if m not in sys.builtin_module_names and m not in ("__main__", "builtins"))
+
+def warm_up_workers(func, client=None, modules=None, wait=False):
+    """
+    Import the modules used by `func` (or `modules`) on all workers, recording import
+    times into each worker's `import_timings` (see cachepreload.py). The imports run
+    as one high-priority task per worker (in a worker thread, not on its event loop).
+    With `wait=False`, the futures are returned right away (e.g., to make chunks meanwhile),
+    otherwise dict of worker -> import times.
+    """
+    import importlib
+    if not client:
+        client = get_client()
+    modules = modules if modules is not None else get_func_modules(func)
+    def f(modules):
+        worker = get_worker()
+        if not hasattr(worker, "import_timings"):
+            worker.import_timings = dict()
+        timings = worker.import_timings
+        for module in modules:
+            if module in timings:
+                continue
+            t0 = time.time()
+            try:
+                importlib.import_module(module)
+                timings[module] = time.time() - t0
+            except Exception:
+                timings[module] = -1.
+        return {module: timings[module] for module in modules}
+    futures = {address: client.submit(f, modules, workers=[address], allow_other_workers=False, pure=False, priority=100)
+            for address in client.scheduler_info()["workers"]}
+    if not wait:
+        return futures
+    return dict(zip(futures, client.gather(list(futures.values()))))
+
+def skim_chunk(df, selection, branches, outdir, codec="none", tag=""):
+    """
+    Write the entries of `df` passing `selection(df)` (boolean mask) for `branches`
+    to a columnar directory under `outdir`, and return dict(skim_outputs=[(path, nentries)])
+    (empty if nothing passed). The directory name depends on the chunk and `tag` (which
+    should identify the selection/branches), so duplicate runs of a chunk (retries,
+    speculative copies) reuse the output of whichever finished first.
+    """
+    mask = np.asarray(selection(df), dtype=bool)
+    nselected = int(mask.sum())
+    if not nselected:
+        return dict(skim_outputs=[])
+    columnar_file = df._get_columnar()
+    if columnar_file is not None and all(b in columnar_file for b in branches):
+        arrays = columnar_file.arrays(branches, df.entry_start, df.entry_stop)
+    else:
+        df._load_tree()
+        arrays = df.tree.arrays(filter_name=branches, entry_start=df.entry_start, entry_stop=df.entry_stop, how=dict,
+                decompression_executor=get_decompression_executor())
+    arrays = {branch: array[mask] for branch, array in arrays.items()}
+    key = hashlib.sha1("{}:{}:{}:{}".format(df.filename, df.entry_start, df.entry_stop, tag).encode()).hexdigest()[:20]
+    path = columnar.write_columns(os.path.join(outdir, key), arrays, nselected, codec=codec, overwrite=False,
+            source=df.filename, treename=df.treename, entry_start=df.entry_start, entry_stop=df.entry_stop)
+    return dict(skim_outputs=[(path, nselected)])
+
+def skim(selection, fnames, branches, outdir, codec="none", index_path=DEFAULT_INDEX_PATH, **kwargs):
+    """
+    Run `selection` (dataframe -> boolean mask, e.g. `lambda df: df["nMuon"] >= 2`) over
+    `fnames` with `get_results` (which gets `kwargs`) and write the selected entries of
+    `branches` as compact columnar directories under `outdir`, one per input chunk.
+    The skimmed files are added to the chunk index and listed in `outdir`/skim.json,
+    and their list is returned, to be passed to `get_results` instead of `fnames`.
+    """
+    import uuid
+    os.makedirs(outdir, exist_ok=True)
+    branches = list(branches)
+    try:
+        # covers partial arguments and callable-object attributes, not just the code
+        tag = _state_token(selection, set())
+    except TypeError:
+        # can't tell if the selection changed since a previous skim, so don't reuse outputs
+        tag = uuid.uuid4().hex
+    tag = hashlib.sha1(repr((tag, branches, codec)).encode()).hexdigest()[:16]
+    def process(df):
+        return skim_chunk(df, selection, branches, outdir, codec=codec, tag=tag)
+    process.__qualname__ = "skim_" + getattr(selection, "__qualname__", "selection")
+    results = get_results(process, fnames, **kwargs)
+    outputs = sorted(set(map(tuple, results.get("skim_outputs", []))))
+    if index_path and outputs:
+        ChunkIndex(index_path).put({path: columnar.get_file_metadata(path) for path, _ in outputs})
+    nselected = sum(n for _, n in outputs)
+    with open(os.path.join(outdir, "skim.json"), "w") as fh:
+        json.dump(dict(fnames=list(fnames), branches=branches, nevents_processed=results["nevents_processed"],
+            nevents_selected=nselected, outputs=outputs), fh)
+    print(f"Skimmed {nselected:.5g} of {results['nevents_processed']:.5g} events into {len(outputs)} files in {outdir}")
+    return [path for path, _ in outputs]
+
+def load_skim(outdir):
+    """
+    Return the list of skimmed files written by `skim` into `outdir`
+    """
+    with open(os.path.join(outdir, "skim.json")) as fh:
+        return [path for path, _ in json.load(fh)["outputs"]]
+
+def get_results(func, fnames, chunksize=250e3, client=None, use_tree_cache=False, skip_bad_files=False, skip_tail_fraction=1.0, wrap_func=True,
+        chunk_strategy="entries", target_bytes=None, reduce_workers=False, fan_in=8,
+        use_cache_affinity=False, speculative=False, speculative_fraction=0.9, speculative_slowness=3.0,
+        branches=None, result_format="dict", adaptive=False, target_task_time=20.,
+        checkpoint=None, checkpoint_key=None, checkpoint_interval=60.,
+        snapshot_callback=None, snapshot_interval=None, snapshot_fraction=None, profile=False, warm_up=False,
+        columnar_path=columnar.DEFAULT_COLUMNAR_PATH):
+    """
+    Run `func` over `fnames` split into chunks on the cluster and return the merged result dict.
+
+    `func` can be a dict of name -> function to run several analyses over one read of
+    each chunk (see `fuse_funcs`). The result then has the merged output of each function
+    under its name, next to the shared "nevents_processed", "t_start", etc.
+
+    With `reduce_workers=True`, partial results are tree-reduced on the workers with
+    `fan_in` results per reduction (see `reduce_on_workers`) and only the final merged
+    dict is sent back to the client.
+
+    With `use_cache_affinity=True`, chunks are loosely restricted to workers that
+    already cache their arrays/trees (see `get_cache_affinity`) instead of the
+    hard filename-based restriction of `use_tree_cache`.
+
+    With `speculative=True` (only for client-side merging), once `speculative_fraction`
+    of chunks are done, chunks running longer than `speculative_slowness` times the
+    median task time are duplicated on other workers (see `speculative_batches`).
+
+    `branches` (list, or "dryrun" to learn them from running `func` on a small slice
+    of the first chunk) are bulk-read for each chunk before `func` runs.
+
+    With `result_format="columnar"`, tasks return `ChunkResult`s, which are serialized
+    with out-of-band buffers and merged into fixed-width timing arrays; the returned
+    object is still converted to a plain dict.
+
+    With `adaptive=True`, a calibration wave of `chunksize` chunks measures the throughput
+    of `func`, and the rest of the entries are cut on the fly into tasks of about
+    `target_task_time` seconds (see `adaptive_batches`).
+
+    With `checkpoint` (True for the default path, a sqlite path, or a `CheckpointStore`),
+    results merged so far are saved every `checkpoint_interval` seconds under a key from
+    `func`, the values of the closure variables/globals it uses, and the chunking
+    arguments (see `get_checkpoint_key`), or `checkpoint_key`. A rerun (e.g., after a dead kernel,
+    evicted workers, or with more files) only processes entry ranges not saved yet.
+
+    With `snapshot_callback`, every `snapshot_interval` seconds and/or `snapshot_fraction`
+    of events (default every 30s), the accumulated results are merged and
+    `snapshot_callback(snapshot)` is called with a copy scaled by total/processed events
+    (see `make_snapshot`), e.g., to plot histograms and decide to stop early. Merging only
+    happens when a snapshot is due, and later merges make new objects, so the snapshot is
+    not modified afterwards (except for types merged with `+=`).
+
+    With `profile=True` (and `wrap_func=True`), tasks record I/O vs user time and
+    per-branch bytes, merged into per-worker summaries under "profile" (see `summarize_profile`).
+
+    With `warm_up=True`, workers import the modules used by `func` in the background
+    while the chunks are being made (see `warm_up_workers`).
+
+    Files converted to a columnar cache under `columnar_path` (see columnar.py) are
+    read from it, others from ROOT. `columnar_path=None` always reads ROOT. The path is
+    used as is on the workers, so the default per-user, per-host ~/.daskucsd/columnar only
+    helps local clusters; point it (or `DASKUCSD_COLUMNAR_PATH`) to shared storage otherwise.
+    """
+    if speculative and reduce_workers:
+        raise ValueError("speculative execution is not supported with reduce_workers=True")
+    if adaptive and (reduce_workers or speculative or use_cache_affinity):
+        raise ValueError("adaptive chunking is not supported with reduce_workers, speculative or use_cache_affinity")
+    if checkpoint and reduce_workers:
+        raise ValueError("checkpointing is not supported with reduce_workers=True")
+    if snapshot_callback and reduce_workers:
+        raise ValueError("snapshots are not supported with reduce_workers=True")
+    if snapshot_callback and not (snapshot_interval or snapshot_fraction):
+        snapshot_interval = 30.
+    if isinstance(func, dict):
+        func = fuse_funcs(func)
+    if not client:
+        client = get_client()
+    # hold on to the warm-up futures while chunking, otherwise they're released (and cancelled) right away
+    warm_up_futures = warm_up_workers(func, client=client) if warm_up else {}
     print("Making chunks for workers")
-    chunks, nevents_total = get_chunking(tuple(fnames), chunksize=chunksize, use_dask=True, skip_bad_files=skip_bad_files)
+    chunks, nevents_total = get_chunking(tuple(fnames), chunksize=chunksize, use_dask=True, skip_bad_files=skip_bad_files,
+            strategy=chunk_strategy, target_bytes=target_bytes, columnar_path=columnar_path)
+    del warm_up_futures
+    checkpointed = []
+    if checkpoint:
+        if not isinstance(checkpoint, CheckpointStore):
+            checkpoint = CheckpointStore() if checkpoint is True else CheckpointStore(checkpoint)
+        checkpoint_key = checkpoint_key or get_checkpoint_key(func, chunksize=chunksize, wrap_func=wrap_func,
+                chunk_strategy=chunk_strategy, target_bytes=target_bytes, result_format=result_format)
+        checkpoint.compact(checkpoint_key)
+        checkpointed = checkpoint.load(checkpoint_key)
+        if checkpointed:
+            done = checkpoint.done_ranges(checkpoint_key)
+            unknown = set(done) - set(fname for chunk in chunks for fname, _, _ in iter_chunk_ranges(chunk))
+            if unknown:
+                raise ValueError(f"Checkpoint {checkpoint_key} has results for {len(unknown)} files not in `fnames` "
+                        f"(e.g., {next(iter(unknown))}). Use another `checkpoint_key` or clear the checkpoint.")
+            chunks = remaining_chunks(chunks, done)
+            nevents_total = sum(map(chunk_nevents, chunks))
+            print(f"Resuming from checkpoint {checkpoint_key} with {checkpointed[0]['nevents_processed']:.5g} events already processed")
     print(f"Processing {len(chunks)} chunks")
     if wrap_func:
-        process = use_chunk_input(func, use_tree_cache=use_tree_cache)
+        if branches == "dryrun" and chunks:
+            branches = client.submit(learn_branches, func, chunks[0], use_tree_cache=use_tree_cache, columnar_path=columnar_path, pure=False).result()
+            print(f"Learned {len(branches)} branches from a dry run: {branches}")
+        process = use_chunk_input(func, use_tree_cache=use_tree_cache, branches=branches, result_format=result_format, profile=profile,
+                columnar_path=columnar_path)
     else:
         process = func
+    if checkpoint:
+        process = record_chunk_ranges(process)
 
     register_yahist_with_dask()
 
     
     chunk_workers = None
     if use_tree_cache:
-        def f():
-            worker = get_worker()
-            return list(worker.tree_cache.keys())
+        def f(dask_worker):
+            return list(dask_worker.tree_cache.keys()) if hasattr(dask_worker, "tree_cache") else []
         filename_to_worker = defaultdict(list)
         for worker, filenames in client.run(f).items():
             for filename in filenames:
                 filename_to_worker[filename].append(worker)
-        chunk_workers = [filename_to_worker[chunk[0]] for chunk in chunks]
+        chunk_workers = [filename_to_worker[next(iter_chunk_ranges(chunk))[0]] for chunk in chunks]
 
-    futures = client.map(process, chunks, workers=chunk_workers)
+    if adaptive:
+        futures = []
+    elif use_cache_affinity:
+        futures = map_with_preferences(process, chunks, get_cache_affinity(chunks, client=client), client=client)
+    else:
+        futures = client.map(process, chunks, workers=chunk_workers, pure=False)
     t0 = time.time()
     bar = tqdm(total=nevents_total, unit="events", unit_scale=True)
-    ac = as_completed(futures, with_results=True)
-    results = []
-    for batch in ac.batches():
-        to_break = False
-        for future, result in batch:
-            results.append(result)
-            bar.update(result["nevents_processed"])
-            if (skip_tail_fraction < 1.0) and (1.0*len(results)/len(futures) >= skip_tail_fraction):
-                print(f"Reached {100*skip_tail_fraction:.1f}% completion. Ignoring tail tasks")
-                to_break = True
-                break
-        if len(results) > 500:
-            results = [combine_dicts(results)]
-        if to_break:
-            break
+    if reduce_workers:
+        try:
+            results = reduce_on_workers(futures, client=client, fan_in=fan_in, nevents=list(map(chunk_nevents, chunks)),
+                    bar=bar, skip_tail_fraction=skip_tail_fraction)
+        finally:
+            client.cancel(futures, force=True)
+    else:
+        if adaptive:
+            batches = adaptive_batches(process, chunks, client=client, target_task_time=target_task_time, futures=futures)
+        elif speculative:
+            batches = speculative_batches(process, chunks, futures, client=client,
+                    start_fraction=speculative_fraction, slowness=speculative_slowness)
+        else:
+            batches = as_completed(futures, with_results=True).batches()
+        # results[:nsaved] are already checkpointed, results[nsaved:] are not. Keeping one list
+        # (rather than the same objects in two lists) matters since mergers may work in place.
+        results = []
+        nsaved = 0
+        def compact(results, nsaved):
+            if not checkpoint:
+                return [combine_dicts(results)], 0
+            saved = [combine_dicts(results[:nsaved])] if nsaved else []
+            unsaved = [combine_dicts(results[nsaved:])] if len(results) > nsaved else []
+            return saved + unsaved, len(saved)
+        t_checkpoint = t_snapshot = time.time()
+        nevents_snapshot = 0
+        ndone = 0
+        try:
+            for batch in batches:
+                to_break = False
+                for future, result in batch:
+                    results.append(result)
+                    ndone += 1
+                    bar.update(result["nevents_processed"])
+                    fraction_done = (1.0*bar.n/nevents_total) if adaptive else (1.0*ndone/len(futures))
+                    if (skip_tail_fraction < 1.0) and (fraction_done >= skip_tail_fraction):
+                        print(f"Reached {100*skip_tail_fraction:.1f}% completion. Ignoring tail tasks")
+                        to_break = True
+                        break
+                if len(results) > 500:
+                    results, nsaved = compact(results, nsaved)
+                if snapshot_callback and results and (
+                        (snapshot_interval and (time.time() - t_snapshot > snapshot_interval)) or
+                        (snapshot_fraction and (bar.n - nevents_snapshot >= snapshot_fraction*nevents_total))):
+                    results, nsaved = compact(results, nsaved)
+                    accumulated = [r.to_dict() if isinstance(r, ChunkResult) else r for r in results]
+                    accumulated = checkpointed + accumulated
+                    # merge copies, so that in-place mergers leave the partial results alone
+                    accumulated = combine_dicts(copy.deepcopy(accumulated)) if len(accumulated) > 1 else accumulated[0]
+                    snapshot_callback(make_snapshot(accumulated, nevents_total + sum(r["nevents_processed"] for r in checkpointed)))
+                    t_snapshot = time.time()
+                    nevents_snapshot = bar.n
+                if checkpoint and len(results) > nsaved and (time.time() - t_checkpoint > checkpoint_interval):
+                    results, nsaved = compact(results, nsaved)
+                    checkpoint.save(checkpoint_key, results[-1])
+                    nsaved = len(results)
+                    t_checkpoint = time.time()
+                if to_break:
+                    break
+        finally:
+            if checkpoint and len(results) > nsaved:
+                results, nsaved = compact(results, nsaved)
+                checkpoint.save(checkpoint_key, results[-1])
+            if adaptive or speculative:
+                batches.close()
+            # also on errors, so the erred and still running tasks don't linger on the cluster
+            client.cancel(futures, force=True)
     bar.close()
     t1 = time.time()
-    results = combine_dicts(results)
-    client.cancel(futures, force=True)
+    if not reduce_workers:
+        results = combine_dicts(results)
+    if isinstance(results, ChunkResult):
+        results = results.to_dict()
+    if checkpointed:
+        results = combine_dicts(checkpointed + ([results] if results else []))
+    results.pop("chunk_ranges", None)
     # list(map(lambda x: x.cancel(), futures))
     # del futures
     nevents_processed = results["nevents_processed"]
@@ -158,8 +1510,164 @@ def get_results(func, fnames, chunksize=250e3, client=None, use_tree_cache=False
     return results
 
 
+class ResultsHandle(object):
+    """
+    Handle for a running `get_results_async` analysis. `await handle` (or
+    `await handle.result()`) returns the final merged dict, while `partial`,
+    `progress` and `nevents_processed` can be inspected as results come in,
+    and `cancel()` stops the run.
+    """
+    def __init__(self, client, futures, nevents_total):
+        self.client = client
+        self.futures = futures
+        self.nevents_total = nevents_total
+        self.nevents_processed = 0
+        self.t_start = time.time()
+        self.task = None
+        self._results = []
+
+    @property
+    def progress(self):
+        return 1.0*self.nevents_processed/max(self.nevents_total, 1)
+
+    @property
+    def partial(self):
+        """
+        Return the merged result of the chunks done so far
+        """
+        if len(self._results) > 1:
+            self._results = [combine_dicts(self._results)]
+        if not self._results:
+            return dict()
+        result = self._results[0]
+        return result.to_dict() if isinstance(result, ChunkResult) else result
+
+    def snapshot(self):
+        """
+        Return `partial` scaled up by total/processed events (see `make_snapshot`)
+        """
+        return make_snapshot(self.partial, self.nevents_total)
+
+    async def _run(self, poll_interval=0.1):
+        import asyncio
+        ac = as_completed(self.futures, with_results=True)
+        try:
+            while not ac.is_empty():
+                batch = ac.next_batch(block=False)
+                if not batch:
+                    await asyncio.sleep(poll_interval)
+                    continue
+                for future, result in batch:
+                    self._results.append(result)
+                    self.nevents_processed += result["nevents_processed"]
+                if len(self._results) > 500:
+                    self._results = [combine_dicts(self._results)]
+            return self.partial
+        finally:
+            self._cancel_futures()
+
+    def _cancel_futures(self):
+        import asyncio
+        pending = [f for f in self.futures if not f.done()]
+        if pending:
+            ret = self.client.cancel(pending, force=True)
+            if asyncio.iscoroutine(ret):
+                asyncio.ensure_future(ret)
+
+    def done(self):
+        return self.task.done()
+
+    def cancel(self):
+        self.task.cancel()
+        self._cancel_futures()
+
+    async def result(self):
+        return await self.task
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def __repr__(self):
+        status = "cancelled" if self.task.cancelled() else ("done" if self.done() else "running")
+        return (f"<ResultsHandle {status}: {self.nevents_processed:.5g}/{self.nevents_total:.5g} events "
+                f"({100*self.progress:.1f}%) in {time.time()-self.t_start:.1f}s>")
+
+async def get_results_async(func, fnames, chunksize=250e3, client=None, use_tree_cache=False, skip_bad_files=False, wrap_func=True,
+        chunk_strategy="entries", target_bytes=None, branches=None, result_format="dict", profile=False, poll_interval=0.1):
+    """
+    Non-blocking variant of `get_results` for use from a running event loop (e.g., a notebook).
+    Chunks are made in a thread and submitted, and the returned `ResultsHandle` merges
+    results in an asyncio task, so several analyses can share one cluster at once:
+
+        handle = await get_results_async(func, fnames)
+        handle.partial  # merged so far
+        results = await handle
+
+    Works with both synchronous and asynchronous (`asynchronous=True`) clients.
+    `func` can be a dict of name -> function, as in `get_results`.
+    """
+    import asyncio
+    if isinstance(func, dict):
+        func = fuse_funcs(func)
+    if not client:
+        client = get_client()
+    loop = asyncio.get_event_loop()
+    make_chunks = functools.partial(get_chunking, tuple(fnames), chunksize=chunksize, use_dask=not client.asynchronous,
+            client=client, skip_bad_files=skip_bad_files, strategy=chunk_strategy, target_bytes=target_bytes)
+    chunks, nevents_total = await loop.run_in_executor(None, make_chunks)
+    if wrap_func:
+        process = use_chunk_input(func, use_tree_cache=use_tree_cache, branches=branches, result_format=result_format, profile=profile)
+    else:
+        process = func
+    register_yahist_with_dask()
+    futures = client.map(process, chunks, pure=False)
+    handle = ResultsHandle(client, futures, nevents_total)
+    handle.task = asyncio.ensure_future(handle._run(poll_interval=poll_interval))
+    return handle
+
+
+_decompression_executor = None
+_branch_usage = defaultdict(set)
+
+def get_decompression_executor():
+    """
+    Return a thread pool shared by all bulk branch reads in this process
+    """
+    global _decompression_executor
+    if _decompression_executor is None:
+        nthreads = int(os.getenv("DASKUCSD_DECOMPRESSION_THREADS", min(4, os.cpu_count() or 1)))
+        _decompression_executor = concurrent.futures.ThreadPoolExecutor(nthreads)
+    return _decompression_executor
+
+def _update_code_hash(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if hasattr(const, "co_code"):
+            _update_code_hash(h, const)
+        else:
+            h.update(repr(const).encode())
+
+def get_func_fingerprint(func):
+    """
+    Return a short hash identifying `func` by its name, bytecode and constants,
+    which is stable across processes (unlike `id(func)`)
+    """
+    funcs = getattr(func, "funcs", None)
+    if funcs is not None:
+        return hashlib.sha1(repr(sorted((name, get_func_fingerprint(f)) for name, f in funcs.items())).encode()).hexdigest()[:16]
+    if isinstance(func, functools.partial):
+        return hashlib.sha1("partial:{}".format(get_func_fingerprint(func.func)).encode()).hexdigest()[:16]
+    if getattr(func, "__code__", None) is None and hasattr(getattr(type(func), "__call__", None), "__code__"):
+        func = type(func).__call__
+    h = hashlib.sha1(getattr(func, "__qualname__", repr(type(func))).encode())
+    code = getattr(func, "__code__", None)
+    if code is not None:
+        _update_code_hash(h, code)
+    return h.hexdigest()[:16]
+
 class DataFrameWrapper(object):
-    def __init__(self, filename, entry_start=None, entry_stop=None, treename="Events", use_tree_cache=False):
+    def __init__(self, filename, entry_start=None, entry_stop=None, treename="Events", use_tree_cache=False, branches=None):
         self.filename = filename
         self.entry_start = entry_start
         self.entry_stop = entry_stop
@@ -182,9 +1690,46 @@ class DataFrameWrapper(object):
         else:
             self.t = uproot4.open(filename)[treename]
 
+        if branches:
+            self.prefetch(branches)
+
+    def _cache_key(self, key):
+        return (self.filename, self.treename, key, self.entry_start, self.entry_stop)
+
+    def prefetch(self, branches):
+        """
+        Read all `branches` that are not loaded or cached yet with a single `tree.arrays` call
+        """
+        cache = get_worker_cache("array_cache")
+        available = set(self.t.keys())
+        missing = []
+        for key in branches:
+            if key in self.data or key not in available:
+                continue
+            array = cache.get(self._cache_key(key)) if cache is not None else None
+            if array is None:
+                missing.append(key)
+            else:
+                self.data[key] = array
+        if not missing:
+            return
+        arrays = self.t.arrays(filter_name=missing, entry_start=self.entry_start, entry_stop=self.entry_stop,
+                how=dict, decompression_executor=get_decompression_executor())
+        for key, array in arrays.items():
+            if cache is not None:
+                cache.put(self._cache_key(key), array)
+            self.data[key] = array
+
     def __getitem__(self, key):
         if key not in self.data:
-            self.data[key] = self.t.get(key).array(entry_start=self.entry_start, entry_stop=self.entry_stop)
+            cache = get_worker_cache("array_cache")
+            cache_key = self._cache_key(key)
+            array = cache.get(cache_key) if cache is not None else None
+            if array is None:
+                array = self.t.get(key).array(entry_start=self.entry_start, entry_stop=self.entry_stop)
+                if cache is not None:
+                    cache.put(cache_key, array)
+            self.data[key] = array
         return self.data[key]
 
     def __len__(self):
@@ -192,123 +1737,536 @@ class DataFrameWrapper(object):
             return self.entry_stop-self.entry_start
         return len(self.t)
 
-def use_chunk_input(func, **kwargs):
+def get_branch_bytes(branch, entry_start, entry_stop):
+    """
+    Return (compressed, uncompressed) bytes of the baskets of uproot4 `branch`
+    overlapping [entry_start, entry_stop)
+    """
+    offsets = branch.entry_offsets
+    compressed = uncompressed = 0
+    for i in range(branch.num_baskets):
+        if offsets[i+1] <= entry_start or offsets[i] >= entry_stop:
+            continue
+        try:
+            compressed += branch.basket_compressed_bytes(i)
+            uncompressed += branch.basket_uncompressed_bytes(i)
+        except Exception:
+            frac = 1.0*(offsets[i+1] - offsets[i])/max(branch.num_entries, 1)
+            compressed += int(branch.compressed_bytes*frac)
+            uncompressed += int(branch.uncompressed_bytes*frac)
+    return compressed, uncompressed
+
+def get_peak_rss():
+    """
+    Return peak resident memory of this process in bytes
+    """
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024
+
+profile_fields = ["ntasks", "nevents", "t_total", "t_io", "t_user", "bytes_compressed", "bytes_uncompressed", "peak_rss"]
+
+def make_task_profile(df, t0, t1, t_func, t_io_func, worker_name):
+    """
+    Return per-worker profile summary ({worker_name: {...}}) for one chunk from the
+    read statistics recorded by a profiling `CachedChunkDataFrame`. Per-branch entries
+    are arrays of [read seconds, compressed bytes, uncompressed bytes, reads].
+    """
+    branches = df.read_stats
+    t_io = sum(stats[0] for stats in branches.values())
+    summary = dict(
+        ntasks=1,
+        nevents=len(df),
+        t_total=t1-t0,
+        t_io=t_io,
+        t_user=max((t1-t_func) - t_io_func, 0.),
+        bytes_compressed=sum(int(stats[1]) for stats in branches.values()),
+        bytes_uncompressed=sum(int(stats[2]) for stats in branches.values()),
+        peak_rss=get_peak_rss(),
+        branches={branch: np.array(stats) for branch, stats in branches.items()},
+    )
+    return {worker_name: summary}
+
+def merge_profiles(values):
+    """
+    Merge per-worker profile summaries, summing everything but the peak RSS
+    """
+    out = dict()
+    for profile in values:
+        for worker, summary in profile.items():
+            if worker not in out:
+                out[worker] = dict(summary, branches=dict(summary["branches"]))
+                continue
+            merged = out[worker]
+            for field in profile_fields:
+                if field == "peak_rss":
+                    merged[field] = max(merged[field], summary[field])
+                else:
+                    merged[field] = merged[field] + summary[field]
+            for branch, stats in summary["branches"].items():
+                merged["branches"][branch] = merged["branches"][branch] + stats if branch in merged["branches"] else stats
+    return out
+
+register_merger(merge_profiles, keys=["profile"])
+
+def summarize_profile(results):
+    """
+    Return (workers, branches) pandas DataFrames summarizing the "profile" of `results`
+    (from running with `profile=True`): per-worker totals, with I/O and user fractions
+    of busy time, and per-branch read time, bytes and decompression ratio
+    """
+    import pandas as pd
+    profile = results["profile"]
+    workers = pd.DataFrame([[summary[field] for field in profile_fields] for summary in profile.values()],
+            index=pd.Index(list(profile.keys()), name="worker"), columns=profile_fields)
+    workers["io_fraction"] = workers["t_io"]/workers["t_total"]
+    workers["user_fraction"] = workers["t_user"]/workers["t_total"]
+    workers["event_rate"] = workers["nevents"]/workers["t_total"]
+    branches = merge_profiles([{"all": summary} for summary in profile.values()])["all"]["branches"] if profile else dict()
+    branches = pd.DataFrame([stats for stats in branches.values()], index=pd.Index(list(branches.keys()), name="branch"),
+            columns=["t_read", "bytes_compressed", "bytes_uncompressed", "nreads"])
+    branches["compression_ratio"] = branches["bytes_uncompressed"]/branches["bytes_compressed"]
+    branches["read_rate"] = branches["bytes_compressed"]/branches["t_read"]
+    return workers, branches.sort_values("t_read", ascending=False)
+
+def get_worker_cache(name):
+    """
+    Return the cache object `name` (e.g., "tree_cache", "array_cache") installed
+    on this worker by cachepreload.py, or None if not running on a worker
+    """
+    try:
+        return getattr(get_worker(), name, None)
+    except ValueError:
+        return None
+
+class CachedChunkDataFrame(pdroot.ChunkDataFrame):
+    """
+    `pdroot.ChunkDataFrame` that reuses the worker's open trees (`tree_cache`),
+    takes branch arrays from the worker's byte-budgeted `array_cache` when possible,
+    can bulk-read a list of branches up front (`prefetch`), and records which
+    branches were read (`accessed`). With `profile=True`, per-branch read time and
+    bytes are recorded in `read_stats`. Branches in a columnar cache of the file
+    under `columnar_path` (see columnar.py) are memory-mapped from it instead.
+    """
+    _metadata = pdroot.ChunkDataFrame._metadata + ["use_tree_cache", "use_array_cache", "accessed", "read_stats",
+            "columnar_path", "columnar"]
+
+    def __init__(self, *args, **kwargs):
+        self.use_tree_cache = kwargs.pop("use_tree_cache", False)
+        self.use_array_cache = kwargs.pop("use_array_cache", True)
+        self.read_stats = dict() if kwargs.pop("profile", False) else None
+        self.columnar_path = kwargs.pop("columnar_path", columnar.DEFAULT_COLUMNAR_PATH)
+        self.columnar = None
+        self.accessed = set()
+        super(CachedChunkDataFrame, self).__init__(*args, **kwargs)
+
+    @property
+    def _constructor(self):
+        return CachedChunkDataFrame
+
+    def _load_tree(self):
+        if self.tree is not None:
+            return
+        if os.path.isdir(self.filename):
+            raise KeyError(f"{self.filename} is a columnar directory (e.g., a skim) without some of the requested branches")
+        cache = get_worker_cache("tree_cache") if self.use_tree_cache else None
+        if cache is not None:
+            if self.filename not in cache:
+                cache[self.filename] = uproot4.open(self.filename)[self.treename]
+            self.tree = cache[self.filename]
+        else:
+            self.tree = uproot4.open(self.filename)[self.treename]
+
+    def _get_columnar(self):
+        """
+        Return the `columnar.ColumnarFile` of this file, or None if it has no cache
+        """
+        if self.columnar is None:
+            self.columnar = columnar.open_columnar(self.filename, self.treename, self.columnar_path) or False
+        return self.columnar or None
+
+    def _read_columns(self, columns):
+        """
+        Return dict of column -> array for `columns`, taking what's possible from the
+        columnar cache, then the array cache, and reading the rest in one `tree.arrays` call
+        """
+        arrays = dict()
+        columnar_file = self._get_columnar()
+        if columnar_file is not None:
+            t0 = time.time()
+            for column in columns:
+                if column not in columnar_file:
+                    continue
+                array = columnar_file.array(column, self.entry_start, self.entry_stop)
+                arrays[column] = array if isinstance(array, np.ndarray) else pdroot.readwrite.array_to_fletcher_or_numpy(array)
+            if self.read_stats is not None and arrays:
+                self._record_reads(list(arrays), time.time() - t0, nbytes=[(a.nbytes, a.nbytes) for a in arrays.values()])
+            columns = [column for column in columns if column not in arrays]
+        cache = get_worker_cache("array_cache") if self.use_array_cache else None
+        missing = []
+        for column in columns:
+            key = (self.filename, self.treename, column, self.entry_start, self.entry_stop)
+            array = cache.get(key) if cache is not None else None
+            if array is None:
+                missing.append(column)
+            else:
+                arrays[column] = array
+        if missing:
+            t0 = time.time()
+            self._load_tree()
+            if len(missing) == 1:
+                raw = {missing[0]: self.tree[missing[0]].array(entry_start=self.entry_start, entry_stop=self.entry_stop)}
+            else:
+                raw = self.tree.arrays(filter_name=missing, entry_start=self.entry_start, entry_stop=self.entry_stop,
+                        how=dict, decompression_executor=get_decompression_executor())
+            for column, array in raw.items():
+                array = pdroot.readwrite.array_to_fletcher_or_numpy(array)
+                if cache is not None:
+                    cache.put((self.filename, self.treename, column, self.entry_start, self.entry_stop), array)
+                arrays[column] = array
+            if self.read_stats is not None:
+                self._record_reads(missing, time.time() - t0)
+        return arrays
+
+    def _record_reads(self, columns, seconds, nbytes=None):
+        """
+        Add read time (split over `columns` by compressed bytes, since a bulk read
+        can't be timed per branch) and basket bytes (or `nbytes`) to `read_stats`
+        """
+        if nbytes is None:
+            nbytes = [get_branch_bytes(self.tree[column], self.entry_start, self.entry_stop) for column in columns]
+        total = sum(compressed for compressed, _ in nbytes)
+        for column, (compressed, uncompressed) in zip(columns, nbytes):
+            share = 1.0*compressed/total if total else 1.0/len(columns)
+            stats = self.read_stats.setdefault(column, [0., 0, 0, 0])
+            stats[0] += seconds*share
+            stats[1] += compressed
+            stats[2] += uncompressed
+            stats[3] += 1
+
+    def _set_column(self, column, array):
+        self.accessed.add(column)
+        if self.orig_index is not None:
+            array = array[self.index.values]
+
+        self[column] = array
+
+        if self.orig_index is None:
+            self.orig_index = self.index
+
+    def _add_column(self, column):
+        self._set_column(column, self._read_columns([column])[column])
+
+    def prefetch(self, branches):
+        """
+        Load all `branches` (that exist in the tree and aren't columns yet) at once
+        """
+        columnar_file = self._get_columnar()
+        if columnar_file is not None and all(b in columnar_file for b in branches):
+            available = set(columnar_file.keys())
+        else:
+            self._load_tree()
+            available = set(self.tree.keys())
+        columns = [b for b in branches if b in available and b not in self.columns.values]
+        for column, array in self._read_columns(columns).items():
+            self._set_column(column, array)
+
+_reserved_keys = ("nevents_processed", "t_start", "t_stop", "worker_name", "profile", "t_io", "chunk_ranges")
+
+def fuse_funcs(funcs):
+    """
+    Return a function that runs each of dict `funcs` (name -> function taking a dataframe)
+    on the same dataframe and returns dict of name -> output, so that branches read by
+    one are reused by the others instead of being read again. Outputs are merged per name
+    by `combine_dicts`. Functions run in order, so one that modifies the dataframe
+    (e.g., adds columns) is seen by the next ones.
+    """
+    funcs = dict(funcs)
+    reserved = set(funcs) & set(_reserved_keys)
+    if reserved:
+        raise ValueError(f"Function names {sorted(reserved)} clash with result keys")
+    def fused(df):
+        return {name: func(df) for name, func in funcs.items()}
+    fused.funcs = funcs
+    fused.__qualname__ = "fused_" + "_".join(funcs)
+    return fused
+
+def learn_branches(func, chunk, nentries=1000, **kwargs):
+    """
+    Return sorted list of branches that `func` reads, from a dry run over
+    the first `nentries` entries of `chunk`
+    """
+    fname, entry_start, entry_stop = next(iter_chunk_ranges(chunk))
+    df = CachedChunkDataFrame(filename=fname, entry_start=entry_start, entry_stop=min(entry_stop, entry_start+nentries),
+            use_array_cache=False, **kwargs)
+    try:
+        func(df)
+    except Exception as e:
+        print(f"Dry run of {getattr(func, '__name__', func)} failed ({e!r}), using branches read so far")
+    return sorted(df.accessed)
+
+def use_chunk_input(func, branches=None, prefetch=True, result_format="dict", profile=False, **kwargs):
+    """
+    Wrap `func`, which takes a dataframe, into a function that takes a chunk.
+    If `branches` is given, they are read up front in one bulk read. Otherwise,
+    with `prefetch=True`, branches read by previous chunks of `func` on this
+    worker are bulk-read up front. With `result_format="columnar"`, the output
+    is returned as a `ChunkResult` instead of a dict.
+
+    With `profile=True`, the output also gets a per-worker summary of I/O vs user
+    time, bytes read/decompressed per branch and peak RSS under "profile" (see
+    `make_task_profile` and `summarize_profile`), and per-task I/O seconds under "t_io".
+
+    `func` can also be a dict of name -> function, which are run on the same dataframe
+    (see `fuse_funcs`).
+    """
+    if isinstance(func, dict):
+        func = fuse_funcs(func)
+    fingerprint = get_func_fingerprint(func)
     def wrapper(chunk):
+        if isinstance(chunk[0], (tuple, list)):
+            return combine_dicts(map(wrapper, chunk))
         # df = DataFrameWrapper(*chunk, **kwargs)
         fname, entry_start, entry_stop = chunk
-        df = pdroot.ChunkDataFrame(filename=fname, entry_start=entry_start, entry_stop=entry_stop)
+        df = CachedChunkDataFrame(filename=fname, entry_start=entry_start, entry_stop=entry_stop, profile=profile, **kwargs)
         t0 = time.time()
+        to_prefetch = branches if branches is not None else (_branch_usage.get(fingerprint) if prefetch else None)
+        if to_prefetch:
+            df.prefetch(to_prefetch)
+        t_func = time.time()
+        t_io_prefetch = sum(stats[0] for stats in df.read_stats.values()) if profile else 0.
         out = func(df)
         t1 = time.time()
+        _branch_usage[fingerprint].update(df.accessed)
+        try:
+            worker_name = get_worker().address
+        except:
+            worker_name = "local"
+        if profile:
+            t_io = sum(stats[0] for stats in df.read_stats.values())
+            out["profile"] = make_task_profile(df, t0, t1, t_func, t_io - t_io_prefetch, worker_name)
+            out["t_io"] = [t_io]
+        if result_format == "columnar":
+            return ChunkResult.from_output(out, t0, t1, len(df), worker_name)
         out["nevents_processed"] = len(df)
         out["t_start"] = [t0]
         out["t_stop"] = [t1]
-        try:
-            out["worker_name"] = [get_worker().address]
-        except:
-            out["worker_name"] = ["local"]
+        out["worker_name"] = [worker_name]
         return out
     return wrapper
 
-def plot_timeflow(results):
+def plot_timeflow(results, nbins=200):
+    """
+    Show the binned worker utilization timeline and efficiency statistics of
+    `results` in the notebook (see `timeline.plot_timeline`, and
+    `timeline.export_report` for static HTML/JSON reports)
+    """
     from bokeh.io import show, output_notebook
-    from bokeh.models import ColumnDataSource
-    from bokeh.plotting import figure
-    import pandas as pd
+    from timeline import plot_timeline
 
     output_notebook()
+    show(plot_timeline(results, nbins=nbins))
+
+
+class StragglerMonitor(SchedulerPlugin):
+    """
+    Scheduler plugin that tracks task start/stop transitions, keeps running
+    per-worker throughput stats (O(1) per transition), and every `check_interval`
+    seconds acts on tasks that have been processing for more than `threshold`
+    seconds (or `slowness` times the mean task duration, if given) according to `policy`:
+    - "log": only record the slow task and mark its worker as degraded
+    - "reschedule": additionally move the task to another worker (the slow worker is
+      excluded with loose restrictions, so it is only used if no other worker is left)
+    - "retire": additionally retire the degraded worker
+    Actions are logged as scheduler events under the "stragglers" topic.
+    """
+    name = "straggler-monitor"
+
+    def __init__(self, threshold=90., slowness=None, policy="log", check_interval=5., min_tasks=10):
+        if policy not in ("log", "reschedule", "retire"):
+            raise ValueError("Unknown straggler policy: {}".format(policy))
+        self.threshold = threshold
+        self.slowness = slowness
+        self.policy = policy
+        self.check_interval = check_interval
+        self.min_tasks = min_tasks
+        self.scheduler = None
+        self.callback = None
+        self.running = dict()
+        self.worker_stats = dict()
+        self.ntasks = 0
+        self.mean_duration = 0.
+        self.degraded = set()
+        self.acted_on = set()
+
+    async def start(self, scheduler):
+        from tornado.ioloop import PeriodicCallback
+        self.scheduler = scheduler
+        if self.callback is None:
+            self.callback = PeriodicCallback(self.check, 1000*self.check_interval)
+            self.callback.start()
+
+    async def close(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+    def transition(self, key, start, finish, *args, **kwargs):
+        if finish == "processing":
+            ts = self.scheduler.tasks.get(key) if self.scheduler else None
+            worker = ts.processing_on.address if (ts is not None and ts.processing_on is not None) else None
+            self.running[key] = (time.time(), worker)
+        elif start == "processing" and key in self.running:
+            t_start, worker = self.running.pop(key)
+            self.acted_on.discard(key)
+            if finish != "memory":
+                return
+            duration = time.time() - t_start
+            for startstop in kwargs.get("startstops", None) or []:
+                if startstop.get("action") == "compute":
+                    duration = startstop["stop"] - startstop["start"]
+            stats = self.get_worker_stats(worker)
+            stats["ntasks"] += 1
+            stats["busy_time"] += duration
+            self.ntasks += 1
+            self.mean_duration += (duration - self.mean_duration) / self.ntasks
+
+    def get_worker_stats(self, worker):
+        if worker not in self.worker_stats:
+            self.worker_stats[worker] = dict(ntasks=0, busy_time=0., nslow=0)
+        return self.worker_stats[worker]
+
+    def get_threshold(self):
+        if self.slowness is not None and self.ntasks >= self.min_tasks:
+            return self.slowness * self.mean_duration
+        return self.threshold
+
+    async def check(self):
+        threshold = self.get_threshold()
+        now = time.time()
+        for key, (t_start, worker) in list(self.running.items()):
+            if (now - t_start < threshold) or (key in self.acted_on):
+                continue
+            self.acted_on.add(key)
+            self.get_worker_stats(worker)["nslow"] += 1
+            self.degraded.add(worker)
+            self.scheduler.log_event("stragglers", dict(
+                key=str(key), worker=worker, elapsed=now-t_start, threshold=threshold, policy=self.policy,
+            ))
+            if self.policy == "reschedule":
+                self.reschedule(key, worker)
+            elif self.policy == "retire" and worker in self.scheduler.workers:
+                await self.scheduler.retire_workers(workers=[worker])
+
+    def reschedule(self, key, worker):
+        ts = self.scheduler.tasks.get(key)
+        if ts is not None:
+            others = set(ts.worker_restrictions or self.scheduler.workers) - {worker}
+            if others:
+                ts.worker_restrictions = others
+                ts.loose_restrictions = True
+        if hasattr(self.scheduler, "_reschedule"):
+            self.scheduler._reschedule(key, worker, stimulus_id="straggler-reschedule-{}".format(time.time()))
+        else:
+            self.scheduler.reschedule(key, worker)
+        self.running.pop(key, None)
+
+    def summary(self):
+        """
+        Return dict of per-worker stats (tasks, busy time, throughput in tasks/s of busy time,
+        slow tasks, degraded flag) along with the global mean task duration
+        """
+        workers = dict()
+        for worker, stats in self.worker_stats.items():
+            workers[worker] = dict(stats,
+                    throughput=(stats["ntasks"] / stats["busy_time"]) if stats["busy_time"] > 0 else 0.,
+                    degraded=worker in self.degraded)
+        return dict(workers=workers, ntasks=self.ntasks, mean_duration=self.mean_duration, nrunning=len(self.running))
+
+def remove_scheduler_plugin(name, client=None):
+    """
+    Close and remove the scheduler plugin called `name`, if any
+    """
+    if not client:
+        client = get_client()
+    async def f(dask_scheduler):
+        plugins = dask_scheduler.plugins
+        if isinstance(plugins, dict):
+            plugin = plugins.get(name)
+        else:
+            plugin = next((p for p in plugins if getattr(p, "name", None) == name), None)
+        if plugin is None:
+            return False
+        if hasattr(plugin, "close"):
+            await plugin.close()
+        try:
+            dask_scheduler.remove_plugin(name=name)
+        except TypeError:
+            dask_scheduler.remove_plugin(plugin)
+        return True
+    return client.run_on_scheduler(f)
+
+def register_scheduler_plugin(plugin, client=None):
+    """
+    Add `plugin` to the scheduler, first closing and removing one with the same name
+    """
+    if not client:
+        client = get_client()
+    remove_scheduler_plugin(plugin.name, client=client)
+    if hasattr(client, "register_scheduler_plugin"):
+        client.register_scheduler_plugin(plugin)
+    else:
+        async def add_plugin(dask_scheduler):
+            dask_scheduler.add_plugin(plugin)
+            await plugin.start(dask_scheduler)
+        client.run_on_scheduler(add_plugin)
+
+def get_straggler_summary(client=None):
+    if not client:
+        client = get_client()
+    def f(dask_scheduler):
+        plugins = dask_scheduler.plugins
+        plugins = plugins.values() if isinstance(plugins, dict) else plugins
+        for plugin in plugins:
+            if getattr(plugin, "name", None) == StragglerMonitor.name:
+                return plugin.summary()
+        return None
+    return client.run_on_scheduler(f)
 
-    df = pd.DataFrame()
-    df["worker"] = results["worker_name"]
-    df["tstart"] = results["t_start"]
-    df["tstop"] = results["t_stop"]
-    df[["tstart","tstop"]] -= df["tstart"].min()
-    df["worker"] = df["worker"].astype("category").cat.codes
-
-    mult, unit = 1, "s"
-
-    df[["tstart","tstop"]] *= mult
-    df["duration"] = df["tstop"] - df["tstart"]
-
-    group = df.groupby("worker")
-    source = ColumnDataSource(group)
-
-    wtime = (df["tstop"]-df["tstart"]).sum()
-    nworkers = df["worker"].nunique()
-    ttime = df["tstop"].max()*nworkers
-    title = (", ".join([
-        "{} workers".format(nworkers),
-        "efficiency = {:.1f}%".format(100.0*wtime/ttime),
-        "median task time = {:.2f}{}".format(group.apply(lambda x:x["tstop"]-x["tstart"]).median(),unit),
-        "median intertask time = {:.2f}{}".format(group.apply(lambda x:x["tstart"].shift(-1)-x["tstop"]).median(),unit),
-        ]))
-
-    p = figure(
-        title=title,
-               tooltips = [
-                   ["worker","@worker"],
-                   ["start","@{tstart}"+unit],
-                   ["stop","@{tstop}"+unit],
-                   ["duration","@{duration}"+unit],
-               ],
-              )
-    p.hbar(y="worker", left="tstart", right="tstop", height=1.0, line_color="black", source=df)
-    p.xaxis.axis_label = "elapsed time since start ({})".format(unit)
-    p.yaxis.axis_label = "worker"
-    p.plot_width = 600
-    p.plot_height = 300
-
-    show(p)
-
-
-def monitor_and_kill_stuck_workers(threshold=90., dryrun=False):
-    from IPython.display import clear_output, display
-    import ipywidgets
-    import datetime
-    import threading
-    import time
-
-    output = ipywidgets.Output()
-    display(output)
-
-    def monitor():
-
-        monitor_interval = 5.0 # seconds
-
-        nloops = 100000 # make 100000 eventually to never end
-
-        # (worker, taskid) -> [tstart, tstop]
-        runtimes_old = dict()
-        runtimes_new = dict()
-
-        output.append_stdout(f"Looking for workers that are taking more than {threshold:.1f}s per task, and killing them.")
-
-        for _ in range(nloops):
-
-            t = time.time()
-            for worker,taskids in client.processing().items():
-                # only care about first task in lineup
-                for taskid in taskids[:1]:
-                    key = (worker, taskid)
-                    tstart = tstop = t
-                    if key in runtimes_old:
-                        tstart = runtimes_old[key][0]
-                    runtimes_new[key] = [tstart, tstop]
-
-            workers_to_kill = []
-            for (worker,taskid),(tstart,tstop) in runtimes_new.items():
-                dt = tstop - tstart
-                if dt >= threshold:
-                    now = datetime.datetime.now()
-                    output.append_stdout(f"[{now}] Killing worker {worker} (stuck for {dt:.1f}s)\n")
-                    workers_to_kill.append(worker)
-            if not dryrun:
-                client.retire_workers(workers_to_kill)
-
-            runtimes_old, runtimes_new = dict(runtimes_new), dict()
-
-            time.sleep(monitor_interval)
-
-    thread = threading.Thread(target=monitor)
-    thread.start()
-    return thread
+class StragglerMonitorHandle(object):
+    """
+    Client-side handle for the `StragglerMonitor` running on the scheduler
+    """
+    def __init__(self, client, policy):
+        self.client = client
+        self.policy = policy
+
+    def summary(self):
+        """
+        Return the monitor's current stats (see `StragglerMonitor.summary`), or None if it was removed
+        """
+        return get_straggler_summary(client=self.client)
+
+    def events(self):
+        return self.client.get_events("stragglers")
+
+    def close(self):
+        return remove_scheduler_plugin(StragglerMonitor.name, client=self.client)
+
+    def __repr__(self):
+        return f"<StragglerMonitorHandle policy={self.policy}>"
+
+def monitor_and_kill_stuck_workers(threshold=90., dryrun=False, client=None, policy="retire", **kwargs):
+    """
+    Install a `StragglerMonitor` on the scheduler which retires (or, with a different `policy`,
+    reschedules/logs) workers running a task for more than `threshold` seconds, replacing
+    a previously installed one. `dryrun=True` only logs. Returns a `StragglerMonitorHandle`,
+    whose `summary()` reads the stats from the scheduler; actions can also be inspected
+    with `client.get_events("stragglers")`.
+    """
+    if not client:
+        client = get_client()
+    plugin = StragglerMonitor(threshold=threshold, policy="log" if dryrun else policy, **kwargs)
+    register_scheduler_plugin(plugin, client=client)
+    print(f"Looking for workers that are taking more than {threshold:.1f}s per task (policy: {plugin.policy})")
+    return StragglerMonitorHandle(client, plugin.policy)